@@ -0,0 +1,74 @@
+#: Compare the formats of the cached Ncell responses by encode/decode time and stored size
+#!? The payload is synthetic with the structure of the availablePackages response, pass --payload to use a saved response instead
+import os, sys
+import time, json, base64, ast
+import argparse, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import codec
+
+#: Return a response with the given number of packages
+def availablePackages(count):
+    random.seed(count)
+    packages = []
+
+    for i in range(count):
+        packages.append({
+            'id': str(1000 + i),
+            'displayInfo': {
+                'displayName': f'Facebook YouTube TikTok Pack {i}',
+                'description': 'Enjoy the social sites and video streaming with high speed 4G data. ' * random.randint(2, 5),
+                'imageUrl': f'https://ncell.axiata.com/images/products/{1000 + i}.png',
+            },
+            'productOfferingPrice': {'price': f'{random.randint(5, 999)}.00', 'priceUom': 'NPR', 'priceType': 'ONE_TIME'},
+            'isBalanceSufficient': random.choice([True, False]),
+            'techInfo': {'subscriptionCode': f'SUB{random.randint(10000, 99999)}', 'productCode': f'P{i}'},
+            'accounts': [
+                {'name': 'Data', 'amount': random.randint(100, 10000), 'amountUom': 'MB', 'validity': random.randint(1, 30), 'validityUom': 'Days'}
+                for _ in range(random.randint(1, 3))
+            ],
+        })
+
+    return {'status': 'success', 'availablePackages': packages}
+
+def legacyEncode(data):
+    return base64.b64encode(str(data).encode()).decode()
+
+def legacyDecode(data):
+    return ast.literal_eval(base64.b64decode(data.encode()).decode())
+
+#: Return the best time of the function in seconds
+def best(function, argument, rounds):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packages', type=int, nargs='+', default=[5, 20, 60], help='number of packages in the synthetic responses')
+    parser.add_argument('--payload', help='JSON file with a saved response')
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    payloads = [(os.path.basename(args.payload), json.load(open(args.payload)))] if args.payload else [(f'{i} packages', availablePackages(i)) for i in args.packages]
+
+    formats = [
+        ('base64(str)', legacyEncode, legacyDecode),
+        ('json', lambda data: codec.encode(data, compressAbove=None), codec.decode),
+        ('json+zlib', lambda data: codec.encode(data, compressAbove=0), codec.decode),
+    ]
+
+    for name, payload in payloads:
+        print(f'\n{name}')
+        for formatName, encode, decode in formats:
+            encoded = encode(payload)
+            assert decode(encoded) == payload
+
+            encodeTime = best(encode, payload, args.rounds)
+            decodeTime = best(decode, encoded, args.rounds)
+            print(f'{formatName:>12}: encode {encodeTime*1e6:9.1f} µs, decode {decodeTime*1e6:9.1f} µs, size {len(encoded):8} bytes')
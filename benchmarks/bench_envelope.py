@@ -0,0 +1,45 @@
+#: Compare the decrypt latency of the chunked RSA and the envelope formats by token length
+#!? The private key is imported once like in an unlocked session, so only the decryption is measured
+import os, sys
+import time, string
+import argparse, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mycrypto
+
+#: Return the best time of the function in seconds
+def best(function, rounds):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lengths', type=int, nargs='+', default=[100, 500, 1000, 2000, 4000], help='length of the tokens in characters')
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    passphrase = 'benchmarkPass000'
+    encryptedPrivateKey, publicKey = mycrypto.generateKeys(passphrase)
+    privateKey = mycrypto.loadPrivateKey(encryptedPrivateKey, passphrase)
+
+    formats = [
+        ('chunked', mycrypto.encryptChunked),
+        ('envelope', mycrypto.encrypt),
+    ]
+
+    for length in args.lengths:
+        token = ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+        print(f'\n{length} characters')
+
+        for formatName, encrypt in formats:
+            cipherText = encrypt(token, publicKey)
+            assert mycrypto.decryptWithKey(cipherText, privateKey) == token
+
+            decryptTime = best(lambda: mycrypto.decryptWithKey(cipherText, privateKey), args.rounds)
+            print(f'{formatName:>9}: decrypt {decryptTime*1e3:8.2f} ms, size {len(cipherText):6} bytes')
@@ -0,0 +1,107 @@
+#: Benchmark of the mycrypto functions on the request path of the encrypted users
+#!? Runs offline with synthetic tokens, and fails if the p50 of a benchmark is slower than the baseline by more than the tolerance
+#!? The baseline depends on the machine, save it again with --save-baseline when the benchmarks run somewhere else
+import os, sys
+import time, json, string
+import argparse, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mycrypto
+
+baselinePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline_mycrypto.json')
+
+#! The time of the key generation depends on the random primes, so it is reported but never fails the run
+ungated = ['generateKeys']
+
+#: Return a synthetic token of the given length, tokens of Ncell are base64 text
+def syntheticToken(length):
+    random.seed(length)
+
+    return ''.join(random.choices(string.ascii_letters + string.digits + '+/', k=length))
+
+#: Return the ops/sec and the p50 and p99 latency in milliseconds of the function
+def measure(function, rounds):
+    #!? One call before measuring, so the first call doesn't count
+    function()
+
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    times.sort()
+
+    return {
+        'opsPerSec': round(len(times) / sum(times), 1),
+        'p50': round(times[len(times) // 2] * 1e3, 4),
+        'p99': round(times[min(len(times) - 1, int(len(times) * 0.99))] * 1e3, 4),
+    }
+
+#: Return the benchmarks as (name, function, rounds)
+def benchmarks(lengths, rounds):
+    passphrase = 'benchmarkPass000'
+    encryptedPrivateKey, publicKey = mycrypto.generateKeys(passphrase)
+    privateKey = mycrypto.loadPrivateKey(encryptedPrivateKey, passphrase)
+    aes = mycrypto.AESCipher(passphrase)
+    encryptedPem = aes.encrypt(privateKey.exportKey().decode())
+
+    #!? Key generation is slow, so it runs fewer rounds
+    yield 'generateKeys', lambda: mycrypto.generateKeys(passphrase), max(10, rounds // 5)
+    yield 'loadPrivateKey', lambda: mycrypto.loadPrivateKey(encryptedPrivateKey, passphrase), rounds
+    yield 'genHash', lambda: mycrypto.genHash(passphrase), rounds * 10
+    yield 'AESCipher.decrypt[privateKey]', lambda: aes.decrypt(encryptedPem), rounds * 10
+
+    for length in lengths:
+        token = syntheticToken(length)
+        envelope = mycrypto.encrypt(token, publicKey)
+        chunked = mycrypto.encryptChunked(token, publicKey)
+        aesToken = aes.encrypt(token)
+
+        yield f'encrypt[{length}]', lambda: mycrypto.encrypt(token, publicKey), rounds
+        yield f'encryptChunked[{length}]', lambda: mycrypto.encryptChunked(token, publicKey), rounds
+        yield f'decrypt[{length}]', lambda: mycrypto.decrypt(envelope, encryptedPrivateKey, passphrase), rounds
+        yield f'decryptWithKey[{length}]', lambda: mycrypto.decryptWithKey(envelope, privateKey), rounds
+        yield f'decryptWithKey.chunked[{length}]', lambda: mycrypto.decryptWithKey(chunked, privateKey), rounds
+        yield f'AESCipher.encrypt[{length}]', lambda: aes.encrypt(token), rounds * 10
+        yield f'AESCipher.decrypt[{length}]', lambda: aes.decrypt(aesToken), rounds * 10
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lengths', type=int, nargs='+', default=[600, 1200, 2400], help='length of the synthetic tokens in characters')
+    parser.add_argument('--rounds', type=int, default=100)
+    parser.add_argument('--baseline', default=baselinePath)
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='allowed p50 slowdown against the baseline, 0.3 is 30%%')
+    args = parser.parse_args()
+
+    baseline = json.load(open(args.baseline)) if os.path.exists(args.baseline) and not args.save_baseline else {}
+    results = {}
+    regressions = []
+
+    print(f"{'benchmark':>34} {'ops/sec':>10} {'p50 ms':>10} {'p99 ms':>10} {'baseline p50':>13}")
+
+    for name, function, rounds in benchmarks(args.lengths, args.rounds):
+        result = measure(function, rounds)
+        results[name] = result
+
+        line = f"{name:>34} {result['opsPerSec']:10.1f} {result['p50']:10.4f} {result['p99']:10.4f}"
+
+        if name in baseline:
+            change = result['p50'] / baseline[name]['p50'] - 1
+            line += f" {baseline[name]['p50']:13.4f} {change*100:+6.1f}%"
+
+            if change > args.tolerance and name not in ungated:
+                regressions.append(name)
+                line += ' ❌'
+
+        print(line)
+
+    if args.save_baseline:
+        json.dump(results, open(args.baseline, 'w'), indent=4)
+        print(f'\n[+] Baseline saved to {args.baseline}.')
+
+    elif regressions:
+        print(f"\n[-] {len(regressions)} regressions over {args.tolerance*100:.0f}%: {', '.join(regressions)}")
+        sys.exit(1)
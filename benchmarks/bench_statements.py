@@ -0,0 +1,51 @@
+#: Compare the lookups built with f-strings against bound parameters
+#!? Every distinct SQL text has to be parsed and planned by SQLite, while the bound statement is parsed once and reused from the statement cache
+import os, sys
+import time, sqlite3
+import argparse, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import migrations
+
+#: Run the query for every user and return the seconds per query
+def run(con, users, query):
+    start = time.perf_counter()
+    for userId in users:
+        query(con, userId)
+
+    return (time.perf_counter() - start) / len(users)
+
+def fString(con, userId):
+    con.execute(f'SELECT isUnlocked FROM settings WHERE ownerId={userId} limit 1').fetchone()
+    con.execute(f'SELECT * FROM accounts WHERE ownerId={userId}').fetchall()
+
+def boundParameter(con, userId):
+    con.execute('SELECT isUnlocked FROM settings WHERE ownerId=? LIMIT 1', (userId,)).fetchone()
+    con.execute('SELECT * FROM accounts WHERE ownerId=?', (userId,)).fetchall()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000, help='number of distinct users to look up')
+    parser.add_argument('--rounds', type=int, default=5, help='number of rounds, the best one is reported')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'bench.sqlite')
+        migrations.migrate(database)
+
+        con = sqlite3.connect(database, isolation_level=None, cached_statements=256)
+        con.execute('BEGIN')
+        for userId in range(1, args.users+1):
+            con.execute('INSERT INTO users (id, telegramId) VALUES (?, ?)', (userId, userId*7))
+            con.execute('INSERT INTO settings (ownerId, defaultAcId) VALUES (?, ?)', (userId, userId))
+            con.execute('INSERT INTO accounts (id, token, msisdnHash, ownerId) VALUES (?, ?, ?, ?)', (userId, 'x'*400, f'{userId:0128x}', userId))
+        con.execute('COMMIT')
+
+        users = list(range(1, args.users+1))
+        results = {}
+        for name, query in [('f-string', fString), ('bound parameter', boundParameter)]:
+            results[name] = min(run(con, users, query) for _ in range(args.rounds))
+            print(f'{name:>16}: {results[name]*1e6:8.2f} µs per lookup, {1/results[name]:10.0f} lookups/sec')
+
+        print(f"\n[+] Bound parameters are {results['f-string']/results['bound parameter']:.2f}x faster over {args.users} distinct users.")
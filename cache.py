@@ -0,0 +1,143 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+#! Returned by get() when the key is not in the cache, so None can be cached as a value
+missing = object()
+
+#: Thread safe LRU cache with an optional time to live for the entries
+#!? onEvict is called with the key and value of the entries which are removed, expired or evicted
+class ttlCache():
+    def __init__(self, maxSize=1024, ttl=None, onEvict=None):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.onEvict = onEvict
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    #: Return the value of the key, default if the key is not in the cache or expired
+    def get(self, key, default=missing):
+        evicted = []
+
+        with self.lock:
+            item = self.data.get(key)
+
+            if item is not None:
+                value, expiresAt = item
+
+                if expiresAt is None or expiresAt > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+
+                    return value
+
+                #!? Expired entry
+                del self.data[key]
+                evicted.append((key, value))
+
+            self.misses += 1
+
+        self.evicted(evicted)
+
+        return default
+
+    #: Add or replace the value of the key, ttl overrides the default time to live of the cache
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+
+        evicted = []
+
+        with self.lock:
+            old = self.data.get(key)
+            if old is not None and old[0] is not value:
+                evicted.append((key, old[0]))
+
+            self.data[key] = (value, time.monotonic() + ttl if ttl else None)
+            self.data.move_to_end(key)
+
+            #!? Evict the least recently used entries
+            while len(self.data) > self.maxSize:
+                oldKey, (oldValue, _) = self.data.popitem(last=False)
+                evicted.append((oldKey, oldValue))
+
+        self.evicted(evicted)
+
+    #: Remove the key from the cache
+    def delete(self, key):
+        with self.lock:
+            item = self.data.pop(key, None)
+
+        if item is not None:
+            self.evicted([(key, item[0])])
+
+    #: Remove all the keys from the cache
+    def clear(self):
+        with self.lock:
+            evicted = [(key, item[0]) for key, item in self.data.items()]
+            self.data.clear()
+
+        self.evicted(evicted)
+
+    #: Call onEvict for the removed entries, outside of the lock
+    def evicted(self, entries):
+        if self.onEvict:
+            for key, value in entries:
+                self.onEvict(key, value)
+
+    #: Return the size and hit/miss counters of the cache
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+
+            return {
+                'size': len(self.data),
+                'maxSize': self.maxSize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / total, 3) if total else 0,
+            }
+
+#: Runs one call at a time for a key, the callers of a key while it runs wait for it and share its result
+class singleFlight():
+    def __init__(self):
+        self.running = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    #: Return (result, shared) of the function, shared is True if the result is of a call made by another caller
+    def do(self, key, function):
+        with self.lock:
+            call = self.running.get(key)
+
+            if call is not None:
+                self.shared += 1
+                waiting = True
+            else:
+                call = self.running[key] = Future()
+                self.calls += 1
+                waiting = False
+
+        if waiting:
+            return call.result(), True
+
+        try:
+            result = function()
+            call.set_result(result)
+
+            return result, False
+
+        except Exception as e:
+            call.set_exception(e)
+            raise
+
+        finally:
+            with self.lock:
+                del self.running[key]
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'shared': self.shared, 'running': len(self.running)}
@@ -0,0 +1,98 @@
+import time
+import logging
+import threading
+from collections import namedtuple
+
+import cache
+
+logger = logging.getLogger('catch_all')
+
+#! Response code of a successful plan list
+successCode = 'QAP1000'
+
+#: Packages of a plan list and the account they were fetched with
+#!? Only the account which fetched the packages can trust their isBalanceSufficient
+catalogEntry = namedtuple('catalogEntry', ['packages', 'fetchedAt', 'accountId'])
+
+#: Plan catalog of Ncell shared by all the users, keyed by (planType, categoryId)
+#!? An entry older than freshTtl is still returned, and refreshed in the background with the client of the user who asked for it.
+#!? Entries older than staleTtl are removed, so they are fetched again while the user waits.
+#!? submit(userKey, function, *args) queues the background refresh after the updates of the user, returns False if it was not queued.
+#!? So the client of the user, which may refresh its token, is never used by the refresh and the user's updates at the same time.
+class catalogCache():
+    def __init__(self, submit, freshTtl=900, staleTtl=21600, maxSize=256):
+        self.submit = submit
+        self.freshTtl = freshTtl
+        self.entries = cache.ttlCache(maxSize, staleTtl)
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.refreshes = 0
+        self.flights = cache.singleFlight()
+
+    #: Return (entry, None) if the key is cached, else (entry, response) after fetching it
+    #!? entry is None if the response of fetch() is not a plan list, the caller handles the response then
+    def get(self, key, fetch, accountId, userKey):
+        entry = self.entries.get(key, None)
+
+        if entry is not None:
+            if time.time() - entry.fetchedAt > self.freshTtl:
+                self.refreshLater(key, fetch, accountId, userKey)
+
+            return entry, None
+
+        #! The users asking for a missing key at the same time share one fetch
+        (entry, response), shared = self.flights.do(key, lambda: self.load(key, fetch, accountId))
+
+        #!? A failed fetch is not shared, because its response depends on the token of the user who fetched it
+        if entry is None and shared:
+            return self.load(key, fetch, accountId)
+
+        return entry, response
+
+    #: Fetch the plan list and cache it if it was successful
+    def load(self, key, fetch, accountId):
+        response = fetch()
+        entry = None
+
+        if response.responseDescCode == successCode:
+            entry = catalogEntry(response.content['availablePackages'], time.time(), accountId)
+            self.entries.set(key, entry)
+
+        return entry, response
+
+    #: Refresh the key in the background, once at a time
+    def refreshLater(self, key, fetch, accountId, userKey):
+        with self.lock:
+            if key in self.refreshing:
+                return
+
+            self.refreshing.add(key)
+
+        #!? A full queue skips the refresh, the next user asking for the key tries again
+        if not self.submit(userKey, self.refresh, key, fetch, accountId):
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def refresh(self, key, fetch, accountId):
+        try:
+            entry, response = self.load(key, fetch, accountId)
+
+            if entry is None:
+                logger.error(f'Catalog {key} was not refreshed: {response.responseDescCode}')
+            else:
+                self.refreshes += 1
+
+        except Exception as e:
+            logger.error(e, exc_info=True)
+
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def stats(self):
+        stats = self.entries.stats()
+        stats['refreshes'] = self.refreshes
+        stats['refreshing'] = len(self.refreshing)
+        stats['sharedFetches'] = self.flights.shared
+
+        return stats
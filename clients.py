@@ -0,0 +1,112 @@
+import sys
+import base64
+import http.cookiejar
+
+import ncellapp
+import requests
+from requests.adapters import HTTPAdapter
+
+import cache
+import resilience
+
+#! Modules of ncellapp whose requests attribute is replaced
+#!? These internals of ncellapp are used here, as in ncellapp 2.0.2 and the unreleased version the bot runs on:
+#!? the modules call requests.post of their own requests attribute, and the clients keep their current token in token
+ncellappModules = ['ncellapp.ncell', 'ncellapp.register']
+
+#: Raise RuntimeError if the installed ncellapp doesn't have the internals used here
+def checkNcellapp():
+    for name in ncellappModules:
+        module = sys.modules.get(name)
+
+        if module is None or not isinstance(getattr(module, 'requests', None), (type(requests), sessionRequests)):
+            raise RuntimeError(f'{name} has no requests module to send with the session, this ncellapp version is not supported')
+
+    #!? Creating a client sends no request
+    token = base64.b64encode(b"{'msisdn': '', 'deviceId': '', 'accessToken': '', 'refreshToken': ''}").decode()
+    try:
+        client = ncellapp.ncell(token)
+    except Exception as e:
+        raise RuntimeError(f'ncellapp.ncell can not read the token ({e!r}), this ncellapp version is not supported')
+
+    if not callable(getattr(client, 'refreshToken', None)):
+        raise RuntimeError('ncellapp.ncell has no refreshToken, this ncellapp version is not supported')
+
+    if getattr(client, 'token', None) != token:
+        raise RuntimeError('ncellapp.ncell has no token attribute, this ncellapp version is not supported')
+
+#: requests module for ncellapp which sends the requests with a shared session
+#!? The session keeps the connections to Ncell alive, everything else is taken from the requests module
+#!? ncellapp sends its requests without a timeout, so the timeout of the guarded call or the default timeout is added
+class sessionRequests():
+    methods = ['request', 'get', 'post', 'put', 'patch', 'delete', 'head', 'options']
+
+    def __init__(self, session, timeout=10):
+        self.session = session
+        self.timeout = timeout
+
+    def __getattr__(self, name):
+        if name in self.methods:
+            method = getattr(self.session, name)
+
+            return lambda *args, **kwargs: method(*args, **{'timeout': resilience.requestTimeout(self.timeout), **kwargs})
+
+        return getattr(requests, name)
+
+#: Return a session with a pool of keep alive connections
+#!? Cookies are never stored, so the session shares nothing between the users like the module level requests
+def newSession(poolSize=16):
+    session = requests.Session()
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=poolSize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+#: Make the modules of ncellapp send their requests with the session
+#!? ncellapp calls requests.post of its own modules, checkNcellapp() fails at the startup if they have changed
+def useSession(session, timeout=10):
+    checkNcellapp()
+
+    for name in ncellappModules:
+        module = sys.modules[name]
+
+        if module.requests is requests:
+            module.requests = sessionRequests(session, timeout)
+
+#: Ncell clients of the accounts, keyed by (userId, accountId)
+#!? A client is reused while its token is the token of the account, and the least recently used clients are evicted after maxSize
+#!? The clients are wrapped by the guard, so their calls have timeouts, retries and the circuit breaker
+#!? A client is shared by the updates of its user, the token refresher and the plan catalog refreshes. They all run on
+#!? the dispatcher under the user's telegramId, so they never call it at the same time.
+class clientRegistry():
+    def __init__(self, afterRefresh, guard, maxSize=5000, ttl=3600):
+        self.afterRefresh = afterRefresh
+        self.guard = guard
+        self.clients = cache.ttlCache(maxSize, ttl)
+
+    #: Return the client of the account, a new client if there is none or its token is not the token of the account
+    def get(self, userId, accountId, token):
+        client = self.clients.get((userId, accountId), None)
+
+        if client is None or client.token != token:
+            client = self.guard.wrap(ncellapp.ncell(token, autoRefresh=True, afterRefresh=self.afterRefresh, args=[userId, accountId, '__token__']))
+            self.clients.set((userId, accountId), client)
+
+        return client
+
+    #: Return the client of the account if there is one, without creating it
+    def cached(self, userId, accountId):
+        return self.clients.get((userId, accountId), None)
+
+    #: Remove the client of the account, unless its token is the given token
+    def invalidate(self, userId, accountId, token=None):
+        client = self.clients.get((userId, accountId), None)
+
+        if client is not None and (token is None or client.token != token):
+            self.clients.delete((userId, accountId))
+
+    def stats(self):
+        return self.clients.stats()
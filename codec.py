@@ -0,0 +1,32 @@
+import ast
+import json, zlib
+from base64 import b64encode, b64decode
+
+#! Every encoded string starts with the version of its format
+#!? 'j1:' is compact JSON and 'z1:' is zlib compressed JSON in base64.
+#!? Strings without a prefix are base64 of str(dict), the format used before versioning. Base64 never contains ':'.
+jsonPrefix = 'j1:'
+zlibPrefix = 'z1:'
+
+#: Encode the response into a string, compressed if the JSON is longer than compressAbove characters
+def encode(data, compressAbove=4096):
+    text = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+    if compressAbove is not None and len(text) > compressAbove:
+        return zlibPrefix + b64encode(zlib.compress(text.encode(), 6)).decode()
+
+    return jsonPrefix + text
+
+#: Decode the string encoded with encode() or with the old base64 format
+def decode(data):
+    prefix = data[:3]
+
+    if prefix == jsonPrefix:
+        return json.loads(data[3:])
+
+    elif prefix == zlibPrefix:
+        return json.loads(zlib.decompress(b64decode(data[3:])))
+
+    #! Old base64 of str(dict)
+    else:
+        return ast.literal_eval(b64decode(data.encode()).decode())
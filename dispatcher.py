@@ -0,0 +1,101 @@
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('catch_all')
+
+#: Runs the tasks on a bounded thread pool, in order for the same key and in parallel for different keys
+#!? Every key has its own queue and at most one task of a key runs at a time.
+#!? After a task, the rest of its queue goes to the back of the pool's queue, so one busy key can't hold a worker.
+class dispatcher():
+    def __init__(self, workers=8, maxQueue=10000, window=1000):
+        self.workers = workers
+        self.maxQueue = maxQueue
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='dispatcher')
+        self.queues = {}
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+        #! Wait and run times of the last tasks, in seconds
+        self.waitTimes = deque(maxlen=window)
+        self.runTimes = deque(maxlen=window)
+
+    #: Queue the task of the key, returns False if the queue is full
+    def submit(self, key, function, *args):
+        with self.lock:
+            if self.queued >= self.maxQueue:
+                self.rejected += 1
+                return False
+
+            self.queued += 1
+            queue = self.queues.get(key)
+
+            #!? A key with a queue already has a runner on the pool
+            if queue is not None:
+                queue.append((function, args, time.monotonic()))
+                return True
+
+            self.queues[key] = deque([(function, args, time.monotonic())])
+
+        self.executor.submit(self.run, key)
+
+        return True
+
+    #: Run the next task of the key
+    def run(self, key):
+        with self.lock:
+            function, args, queuedAt = self.queues[key].popleft()
+
+        startedAt = time.monotonic()
+        failed = False
+        try:
+            function(*args)
+        except Exception as e:
+            failed = True
+            logger.error(e, exc_info=True)
+
+        finishedAt = time.monotonic()
+
+        with self.lock:
+            self.queued -= 1
+            self.processed += 1
+            self.failed += failed
+            self.waitTimes.append(startedAt - queuedAt)
+            self.runTimes.append(finishedAt - startedAt)
+
+            if not self.queues[key]:
+                del self.queues[key]
+                return
+
+        self.executor.submit(self.run, key)
+
+    #: Return the queue depth, counters and the p50/p99 of the wait and run times in milliseconds
+    def stats(self):
+        with self.lock:
+            waitTimes = sorted(self.waitTimes)
+            runTimes = sorted(self.runTimes)
+
+            return {
+                'workers': self.workers,
+                'queued': self.queued,
+                'keys': len(self.queues),
+                'processed': self.processed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'waitP50': percentile(waitTimes, 0.5),
+                'waitP99': percentile(waitTimes, 0.99),
+                'runP50': percentile(runTimes, 0.5),
+                'runP99': percentile(runTimes, 0.99),
+            }
+
+#: Return the percentile of the sorted times in milliseconds
+def percentile(times, fraction):
+    if not times:
+        return 0
+
+    return round(times[min(len(times) - 1, int(len(times) * fraction))] * 1e3, 1)
@@ -1,25 +1,17 @@
 import sqlite3
-import os, json
+import json
 
-config = json.load(open('config.json'))
-database = config['database']
-
-if os.path.exists(database):
-    os.remove(database)
-    print('[-] Database already exists. Deleting it.')
-
-conn = sqlite3.connect(database)
-print('[+] Database opened successfully.')
-
-conn.execute('''CREATE TABLE users
+#! Migrations are applied in order and only once, the version of the database is kept in the schema_version table
+#!? Never edit a released migration, add a new one instead
+migrations = [
+    (1, 'Create the tables', [
+        '''CREATE TABLE IF NOT EXISTS users
          (id        INTEGER PRIMARY KEY AUTOINCREMENT,
          telegramId TEXT,
          facebookId TEXT
-         );''')
-
-print('[+] Table users created successfully.')
+         );''',
 
-conn.execute('''CREATE TABLE settings
+        '''CREATE TABLE IF NOT EXISTS settings
          (ownerId       INTEGER PRIMARY KEY,
          isEncrypted    TEXT,
          privateKey     TEXT,
@@ -28,27 +20,88 @@ conn.execute('''CREATE TABLE settings
          isUnlocked     TEXT DEFAULT True,
          language       TEXT,
          defaultAcId    INTEGER
-         );''')
-         
-print('[+] Table settings created successfully.')
+         );''',
 
-conn.execute('''CREATE TABLE accounts
-         (id        INTEGER PRIMARY KEY  AUTOINCREMENT, 
+        '''CREATE TABLE IF NOT EXISTS accounts
+         (id        INTEGER PRIMARY KEY  AUTOINCREMENT,
          token      TEXT    NOT NULL,
          msisdnHash TEXT    NOT NULL,
          ownerId    INTEGER NOT NULL
-         );''')
-         
-print('[+] Table accounts created successfully.')
+         );''',
 
-conn.execute('''CREATE TABLE tempdata
+        '''CREATE TABLE IF NOT EXISTS tempdata
          (ownerId           INTEGER PRIMARY KEY,
          registerMsisdn     TEXT,
          rechargeTo,        TEXT,
          sendSmsTo          TEXT,
          responseData       TEXT
+         );''',
+    ]),
+
+    (2, 'Index the user and account lookups', [
+        'CREATE INDEX IF NOT EXISTS usersTelegramId ON users (telegramId)',
+        'CREATE INDEX IF NOT EXISTS usersFacebookId ON users (facebookId)',
+        'CREATE INDEX IF NOT EXISTS accountsOwnerMsisdn ON accounts (ownerId, msisdnHash)',
+    ]),
+
+    (3, 'Make the MSISDN of an account unique per user', [
+        #!? Keep the first of the duplicated accounts like setAccount did, and point the default accounts to it
+        '''UPDATE settings SET defaultAcId=(SELECT MIN(duplicate.id) FROM accounts account, accounts duplicate
+            WHERE account.id=settings.defaultAcId AND duplicate.ownerId=account.ownerId AND duplicate.msisdnHash=account.msisdnHash)
+            WHERE defaultAcId IN (SELECT id FROM accounts)''',
+        'DELETE FROM accounts WHERE id NOT IN (SELECT MIN(id) FROM accounts GROUP BY ownerId, msisdnHash)',
+        'DROP INDEX IF EXISTS accountsOwnerMsisdn',
+        'CREATE UNIQUE INDEX accountsOwnerMsisdn ON accounts (ownerId, msisdnHash)',
+    ]),
+
+    (4, 'Store the MSISDN shown in the account lists', [
+        #!? Masked for the encrypted users, filled for the existing accounts when they are listed
+        'ALTER TABLE accounts ADD COLUMN displayMsisdn TEXT',
+    ]),
+
+    (5, 'Track when the account tokens expire', [
+        #!? Filled when a token is added or refreshed, the proactive token refresh looks up the tokens by it
+        'ALTER TABLE accounts ADD COLUMN tokenExpiresAt REAL',
+        'CREATE INDEX accountsTokenExpiresAt ON accounts (tokenExpiresAt)',
+    ]),
+]
+
+#: Return the schema version of the database, 0 for a new database
+def schemaVersion(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version
+         (version       INTEGER PRIMARY KEY,
+         description    TEXT,
+         appliedOn      TEXT DEFAULT CURRENT_TIMESTAMP
          );''')
-         
-print('[+] Table tempdata created successfully.')
 
-conn.close()
\ No newline at end of file
+    return conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0
+
+#: Upgrade the database in place to the latest version
+def migrate(database):
+    conn = sqlite3.connect(database, isolation_level=None)
+    version = schemaVersion(conn)
+
+    for migrationVersion, description, statements in migrations:
+        if migrationVersion <= version:
+            continue
+
+        #!? Every migration is applied in a transaction, so a failed migration leaves the database untouched
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for statement in statements:
+                conn.execute(statement)
+
+            conn.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)', (migrationVersion, description))
+            conn.execute('COMMIT')
+
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        print(f'[+] Database migrated to version {migrationVersion}: {description}.')
+
+    conn.close()
+
+if __name__ == '__main__':
+    config = json.load(open('config.json'))
+    migrate(config['database'])
@@ -1,79 +1,228 @@
 import sqlite3
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+import cache, sessions, codec
+
+#! Columns of the settings and tempdata tables which can be read and written by name
+#!? Column names can't be bound as parameters, so only these are allowed in the queries
+settingColumns = ['isEncrypted', 'privateKey', 'publicKey', 'passphraseHash', 'isUnlocked', 'language', 'defaultAcId']
+tempdataColumns = ['registerMsisdn', 'rechargeTo', 'sendSmsTo', 'responseData']
+
+#: Everything a handler needs to know about a user, loaded with a single query
+userContext = namedtuple('userContext', ['userId'] + settingColumns + ['defaultAc', 'accountCount'])
 
 class dbQuery():
-    def __init__(self, db):
+    #! Pragmas applied on every new connection
+    pragmas = [
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA cache_size=-16000',
+        'PRAGMA temp_store=MEMORY',
+    ]
+
+    def __init__(self, db, cacheSize=10000, cacheTtl=600, sessionStore=None):
         self.db = db
+        self.local = threading.local()
+
+        #! Temporary data of the conversations is kept in the session store instead of the database
+        self.sessions = sessionStore or sessions.memoryStore()
+
+        #! Cache of telegramId to userId and userId to the settings row
+        self.userIds = cache.ttlCache(cacheSize, cacheTtl)
+        self.settings = cache.ttlCache(cacheSize, cacheTtl)
+
+        #! Number of the cache invalidations, a read is only cached if there was none while it was read
+        self.writes = 0
+        self.writesLock = threading.Lock()
+
+    #: Return the connection of the current thread, opens a new one on the first use
+    #!? Connections are in autocommit mode, so reads never commit and every write is committed by itself
+    @property
+    def con(self):
+        con = getattr(self.local, 'con', None)
+
+        if con is None:
+            con = sqlite3.connect(self.db, timeout=10, isolation_level=None, cached_statements=256)
+            for pragma in self.pragmas:
+                con.execute(pragma)
+
+            self.local.con = con
+
+        return con
+
+    #: Close the connection of the current thread
+    def close(self):
+        con = getattr(self.local, 'con', None)
+
+        if con is not None:
+            con.close()
+            self.local.con = None
+
+    #: Group the writes of the current thread in one transaction and commit them together
+    #!? If an exception is raised, all the writes are rolled back. Nested transactions use savepoints.
+    @contextmanager
+    def transaction(self):
+        con = self.con
+        depth = getattr(self.local, 'depth', 0)
+
+        if depth:
+            con.execute(f'SAVEPOINT transaction{depth}')
+        else:
+            con.execute('BEGIN IMMEDIATE')
+            self.local.touched = set()
+
+        self.local.depth = depth + 1
+        try:
+            yield self
+
+        except BaseException:
+            self.local.depth = depth
+
+            if depth:
+                con.execute(f'ROLLBACK TO transaction{depth}')
+                con.execute(f'RELEASE transaction{depth}')
+            else:
+                con.execute('ROLLBACK')
+
+                #!? The cache may have been filled with the rolled back values
+                self.invalidate(self.local.touched)
+            raise
+
+        else:
+            self.local.depth = depth
+            con.execute(f'RELEASE transaction{depth}' if depth else 'COMMIT')
+
+            #!? Other threads may have cached the old values between forget() and the commit
+            if not depth:
+                self.invalidate(self.local.touched)
+
+    #: Remove the key from the cache, and again when the current transaction ends
+    def forget(self, store, key):
+        self.invalidate([(store, key)])
+
+        if getattr(self.local, 'depth', 0):
+            self.local.touched.add((store, key))
+
+    #: Remove the (store, key) pairs from the cache, so the reads running at the same time are not cached
+    def invalidate(self, keys):
+        with self.writesLock:
+            self.writes += 1
+
+            for store, key in keys:
+                store.delete(key)
+
+    #: Return the column name from the allowed columns, raises ValueError for other names
+    @staticmethod
+    def column(var, columns):
+        for column in columns:
+            if column.lower() == var.lower():
+                return column
+
+        raise ValueError(f'Unknown column {var}')
+
+    #: Return the hit/miss counters of the caches
+    def cacheStats(self):
+        return {'userIds': self.userIds.stats(), 'settings': self.settings.stats()}
     
     #: Return the userId of the telegram or facebook user. Returns None if the user is not registered.
     #!? Supposed to pass only either telegramId or facebookId 
-    def getUserId(self, telegramId='NULL', facebookId='NULL'):
-        with sqlite3.connect(self.db) as con:
-            cur = con.cursor()
-            user = cur.execute(f'SELECT * FROM users WHERE telegramId={telegramId} OR facebookId={facebookId}').fetchone()
-            con.commit()
+    def getUserId(self, telegramId=None, facebookId=None):
+        if telegramId != None:
+            userId = self.userIds.get(telegramId)
+            if userId is not cache.missing:
+                return userId
+
+        user = self.con.execute('SELECT * FROM users WHERE telegramId=? OR facebookId=?', (telegramId, facebookId)).fetchone()
+
+        #!? Only registered users are cached, so the user is found as soon as it is added
+        if user!=None and telegramId != None:
+            self.userIds.set(telegramId, user[0])
             
-            return user[0] if user!=None else None
+        return user[0] if user!=None else None
+
+    #! Query of getUserContext
+    userContextQuery = f'''SELECT users.id, {', '.join(f'settings.{i}' for i in settingColumns)}, accounts.*,
+        (SELECT COUNT(*) FROM accounts WHERE ownerId=users.id)
+        FROM users
+        LEFT JOIN settings ON settings.ownerId=users.id
+        LEFT JOIN accounts ON accounts.id=settings.defaultAcId AND accounts.ownerId=users.id
+        WHERE users.telegramId=? LIMIT 1'''
+
+    #: Return the userContext of the telegram user with the settings, default account and number of accounts
+    #!? userId is None if the user is not registered
+    def getUserContext(self, telegramId):
+        row = self.con.execute(self.userContextQuery, (telegramId,)).fetchone()
+
+        if row == None:
+            return userContext(None, *[None]*len(settingColumns), None, 0)
+
+        self.userIds.set(telegramId, row[0])
+
+        #!? The account columns are between the settings and the account count
+        defaultAc = row[len(settingColumns)+1:-1]
+
+        return userContext(row[0], *row[1:len(settingColumns)+1], defaultAc if defaultAc[0]!=None else None, row[-1])
 
     #: Add the telegram or facebook user into the database and give them a unique UserId
-    def setUserId(self, telegramId='NULL', facebookId='NULL'):
-        with sqlite3.connect(self.db) as con:
-            cursor = con.cursor()
-            cursor.execute(f'Insert into users (telegramId) values ({telegramId})')
-            con.commit()
+    def setUserId(self, telegramId=None, facebookId=None):
+        cursor = self.con.execute('INSERT INTO users (telegramId, facebookId) VALUES (?, ?)', (telegramId, facebookId))
 
-    #: Add account in the user's accounts table
-    def setAccount(self, userId, token, msisdnHash):
-        with sqlite3.connect(self.db) as con:
-            cursor = con.cursor()
-             
-            #!? If the MSISDN hash not on the table, insert new
-            if cursor.execute(f'SELECT * FROM accounts WHERE ownerId={userId} AND msisdnHash="{msisdnHash}"').fetchone() == None:
-                cursor.execute(f'INSERT INTO accounts (token,msisdnHash,ownerId) VALUES ("{token}","{msisdnHash}",{userId})')
-                accountId = cursor.lastrowid
-                con.commit()
-
-            #!? If the MSISDN hash is already on the table, update the table
-            else:
-                accountId = cursor.execute(f'SELECT * FROM accounts WHERE ownerId={userId} AND msisdnHash="{msisdnHash}"').fetchone()[0]
-                cursor.execute(f'UPDATE accounts SET token="{token}" WHERE id={accountId} AND ownerId={userId}')
-                con.commit()
+        if telegramId != None:
+            self.forget(self.userIds, telegramId)
+            self.userIds.set(telegramId, cursor.lastrowid)
 
-        #!? Set the added account as the default account
-        self.setDefaultAc(userId, accountId)    
+    #: Add account in the user's accounts table
+    def setAccount(self, userId, token, msisdnHash, displayMsisdn=None, tokenExpiresAt=None):
+        with self.transaction():
+            #!? If the MSISDN hash is already on the table, update the token of that account
+            accountId = self.con.execute('''INSERT INTO accounts (token, msisdnHash, ownerId, displayMsisdn, tokenExpiresAt) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (ownerId, msisdnHash) DO UPDATE SET token=excluded.token, displayMsisdn=excluded.displayMsisdn, tokenExpiresAt=excluded.tokenExpiresAt
+                RETURNING id''', (token, msisdnHash, userId, displayMsisdn, tokenExpiresAt)).fetchall()[0][0]
 
-    #: Update the token of existing user's account
-    def updateAccount(self, userId, accountId, token):
-        with sqlite3.connect(self.db) as con:
-            cursor = con.cursor()
+            #!? Set the added account as the default account
+            self.setDefaultAc(userId, accountId)    
 
-            cursor.execute(f'UPDATE accounts set token="{token}" where id={accountId} AND ownerId={userId}')
-            con.commit()
+    #: Update the token of existing user's account, the expiry is kept if tokenExpiresAt is None
+    def updateAccount(self, userId, accountId, token, tokenExpiresAt=None):
+        self.con.execute('UPDATE accounts SET token=?, tokenExpiresAt=COALESCE(?, tokenExpiresAt) WHERE id=? AND ownerId=?', (token, tokenExpiresAt, accountId, userId))
     
+    #: Update the token of the user's account only if it is still oldToken, returns True if it was updated
+    def replaceToken(self, userId, accountId, oldToken, token):
+        return self.con.execute('UPDATE accounts SET token=? WHERE id=? AND ownerId=? AND token=?', (token, accountId, userId, oldToken)).rowcount == 1
+
+    #: Update the MSISDN shown for the user's account
+    def setDisplayMsisdn(self, userId, accountId, displayMsisdn):
+        self.con.execute('UPDATE accounts SET displayMsisdn=? WHERE id=? AND ownerId=?', (displayMsisdn, accountId, userId))
+
+    #: Return (accountId, userId, telegramId, tokenExpiresAt) of up to limit accounts whose token expires until the time before, in the order of expiry
+    #!? The accounts start after the account afterId expiring at the time after, so the next call continues from the last returned account
+    #!? telegramId is stored as TEXT, it is returned as the integer id of the updates, which the dispatcher uses as the key of the user
+    def getExpiringAccounts(self, after, before, limit, afterId=0):
+        return self.con.execute('''SELECT accounts.id, accounts.ownerId, CAST(users.telegramId AS INTEGER), accounts.tokenExpiresAt FROM accounts
+            JOIN users ON users.id=accounts.ownerId
+            WHERE (accounts.tokenExpiresAt, accounts.id)>(?, ?) AND accounts.tokenExpiresAt<=?
+            ORDER BY accounts.tokenExpiresAt, accounts.id LIMIT ?''', (after, afterId, before, limit)).fetchall()
+
     #: Get all the registered users
     def getAllAccounts(self):
-        with sqlite3.connect(self.db) as con:
-            cur = con.cursor()
-            users = cur.execute(f'SELECT * FROM users WHERE telegramId NOT NULL').fetchall()
-            con.commit()
+        users = self.con.execute('SELECT * FROM users WHERE telegramId NOT NULL').fetchall()
 
-            return users if users else None
+        return users if users else None
 
     #: Gel all accounts of certain user
     def getAccounts(self, userId):
-        with sqlite3.connect(self.db) as con:
-            cur = con.cursor()
-            accounts = cur.execute(f'SELECT * FROM accounts WHERE ownerId={userId}').fetchall()
-            con.commit()
+        accounts = self.con.execute('SELECT * FROM accounts WHERE ownerId=? ORDER BY id', (userId,)).fetchall()
 
-            return accounts if accounts else None
+        return accounts if accounts else None
     
     #: Delete a user's account
     def deleteAccount(self, userId, accountId):
-        with sqlite3.connect(self.db) as con:
-            cur = con.cursor()
+        with self.transaction():
             defaultAcId = self.getSetting(userId, 'defaultAcId')
-            cur.execute(f'DELETE FROM accounts WHERE ownerId={userId} AND id={accountId}')
-            con.commit()
+            self.con.execute('DELETE FROM accounts WHERE ownerId=? AND id=?', (userId, accountId))
+            self.forget(self.settings, userId)
 
             #!? If the deleted account is the default account, set another account as a default account
             if str(accountId) == str(defaultAcId):
@@ -89,80 +238,92 @@ class dbQuery():
    
     #: Delete all user's account
     def deleteAccounts(self, userId):
-        with sqlite3.connect(self.db) as con:
-            cur = con.cursor()
-            cur.execute(f'DELETE FROM accounts WHERE ownerId={userId}')
-            con.commit()
+        with self.transaction():
+            self.con.execute('DELETE FROM accounts WHERE ownerId=?', (userId,))
+            self.forget(self.settings, userId)
 
             #!? Make the default account NULL
             self.setSetting(userId, 'defaultAcId', None)
                 
     #: Get the default account of the user
     def getDefaultAc(self, userId):
-        with sqlite3.connect(self.db) as con:
-            cur = con.cursor()  
-            defaultAcId = self.getSetting(userId, 'defaultAcId')
-
-            #!? If defaultAcId, return the account
-            if defaultAcId:
-                account = cur.execute(f'SELECT * FROM accounts WHERE ownerId={userId} AND id={defaultAcId}').fetchone()
-                con.commit()
+        defaultAcId = self.getSetting(userId, 'defaultAcId')
 
-                return account      
-            else:
-                return None
+        #!? If defaultAcId, return the account
+        if defaultAcId:
+            return self.con.execute('SELECT * FROM accounts WHERE ownerId=? AND id=?', (userId, defaultAcId)).fetchone()
+        else:
+            return None
 
     #: Set a user's default account
     def setDefaultAc(self, userId, accountId):
-        with sqlite3.connect(self.db) as con:
-            cur = con.cursor()
-            cur.execute(f'INSERT OR IGNORE INTO settings (ownerId, defaultAcId) VALUES ({userId}, {accountId})')
-            cur.execute(f'UPDATE settings SET defaultAcId={accountId} WHERE ownerId={userId}')
-            con.commit()
+        self.con.execute('''INSERT INTO settings (ownerId, defaultAcId) VALUES (?, ?)
+            ON CONFLICT (ownerId) DO UPDATE SET defaultAcId=excluded.defaultAcId''', (userId, accountId))
+        self.forget(self.settings, userId)
 
-    #: Get the user's settings
-    def getSetting(self, userId, var):
-        with sqlite3.connect(self.db) as con:
-            cur = con.cursor()
-            setting = cur.execute(f'SELECT {var} FROM settings WHERE ownerId={userId} limit 1').fetchone()
-            con.commit()
+    #: Get the user's settings row as a dictionary with lowercase column names
+    def getSettings(self, userId):
+        settings = self.settings.get(userId)
+
+        if settings is cache.missing:
+            writes = self.writes
+            cur = self.con.execute('SELECT * FROM settings WHERE ownerId=? LIMIT 1', (userId,))
+            row = cur.fetchone()
+
+            settings = {column[0].lower(): value for column, value in zip(cur.description, row)} if row else {}
 
-            return setting[0] if setting!=None else None
+            #!? A row read in a transaction may not be committed, and a row read during a write may be the old one
+            #!? The check and the set hold the lock of invalidate(), so no write can come in between
+            if not getattr(self.local, 'depth', 0):
+                with self.writesLock:
+                    if writes == self.writes:
+                        self.settings.set(userId, settings)
+
+        return settings
+
+    #: Get the user's setting
+    #!? Column names are case insensitive in SQLite, so are they here
+    def getSetting(self, userId, var):
+        return self.getSettings(userId).get(self.column(var, settingColumns).lower())
 
     #: Set the user's settings    
     def setSetting(self, userId, var, value):
-        with sqlite3.connect(self.db) as con:
-            cur = con.cursor()
+        var = self.column(var, settingColumns)
 
-            #!? If value is None, put value as NULL else "{string}"
-            value = f'"{value}"' if value else 'NULL'
-            cur.execute(f'INSERT OR IGNORE INTO settings (ownerId, {var}) VALUES ({userId}, {value})')
-            cur.execute(f'UPDATE settings SET {var}={value} WHERE ownerId={userId}')
-            con.commit()
+        #!? If value is None, put value as NULL else the string of the value
+        value = str(value) if value else None
+        self.con.execute(f'''INSERT INTO settings (ownerId, {var}) VALUES (?, ?)
+            ON CONFLICT (ownerId) DO UPDATE SET {var}=excluded.{var}''', (userId, value))
+        self.forget(self.settings, userId)
 
     #: Get the user's temporary variable
     def getTempdata(self, userId, var):
-        with sqlite3.connect(self.db) as con:
-            cur = con.cursor()
-            data = cur.execute(f'SELECT {var} FROM tempdata WHERE ownerId={userId} limit 1').fetchone()
-            con.commit()
-
-            return data[0] if data!=None else None
+        return self.sessions.get(userId, self.column(var, tempdataColumns))
     
-    #: Set the user's temporary variable
-    def setTempdata(self, userId, var, value):
-        with sqlite3.connect(self.db) as con:
-            cur = con.cursor()
-
-            #!? If value is None, put value as NULL else "{string}"
-            value = f'"{value}"' if value else 'NULL'
-            cur.execute(f'INSERT OR IGNORE INTO tempdata (ownerId, {var}) VALUES ({userId}, {value})')
-            cur.execute(f'UPDATE tempdata SET {var}={value} WHERE ownerId={userId}')
-            con.commit()
+    #: Set the user's temporary variable, ttl overrides the default time to live of the session store
+    def setTempdata(self, userId, var, value, ttl=None):
+        #!? If value is None, the variable is deleted, else the string of the value is stored
+        self.sessions.set(userId, self.column(var, tempdataColumns), str(value) if value else None, ttl)
 
     #: Delete all temporary data of a user
     def deleteAllTempdata(self, userId):
-        with sqlite3.connect(self.db) as con:
-            cur = con.cursor()
-            cur.execute(f'DELETE FROM tempdata WHERE ownerId={userId}')
-            con.commit()
\ No newline at end of file
+        self.sessions.delete(userId)
+
+    #: Replace the user's list of products, every product is stored under its own key for the lookups by id
+    def setProducts(self, userId, listName, products, ttl=None):
+        oldIds = self.sessions.get(userId, f'{listName}Ids')
+
+        if oldIds:
+            for productId in oldIds.split(','):
+                self.sessions.delete(userId, f'{listName}:{productId}')
+
+        for productId, product in products.items():
+            self.sessions.set(userId, f'{listName}:{productId}', codec.encode(product), ttl)
+
+        self.sessions.set(userId, f'{listName}Ids', ','.join(products) or None, ttl)
+
+    #: Get a product from the user's list of products, None if it is not in the list
+    def getProduct(self, userId, listName, productId):
+        product = self.sessions.get(userId, f'{listName}:{productId}')
+
+        return codec.decode(product) if product else None
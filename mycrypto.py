@@ -1,21 +1,111 @@
+import queue
 import hashlib
+import logging
+import threading
+from itertools import repeat
+from concurrent.futures import BrokenExecutor
 from Crypto.PublicKey import RSA
 from base64 import b64encode, b64decode
 from Crypto.Cipher import PKCS1_OAEP, AES
+from Crypto.Random import get_random_bytes
+
+import cache
+
+logger = logging.getLogger('catch_all')
 
 #: Generate a pair of encrypted privateKey and a publicKey
-def generateKeys(passphrase):
-    privateKey = RSA.generate(1024)
-    publicKey = privateKey.publickey().exportKey().decode()
+#!? The pair is taken from the pool if it has one, else it is generated here
+def generateKeys(passphrase, pool=None):
+    pair = pool.get() if pool else None
+    privateKey, publicKey = pair or newKeyPair()
 
     #! Encrypting privateKey
     aes = AESCipher(passphrase)
-    encryptedPrivateKey = aes.encrypt(privateKey.exportKey().decode())
+    encryptedPrivateKey = aes.encrypt(privateKey)
 
     return encryptedPrivateKey, publicKey
 
-#: Encryption with RSA using publicKey
+#: Generate a new RSA key, returns the privateKey and the publicKey in PEM
+def newKeyPair(keySize=1024):
+    privateKey = RSA.generate(keySize)
+
+    return privateKey.exportKey().decode(), privateKey.publickey().exportKey().decode()
+
+#: Pool of key pairs generated in the background by the processes of the executor
+#!? The pool is filled again whenever a pair is taken, generateKeys falls back to newKeyPair when it is empty
+class keyPool():
+    def __init__(self, executor, size=4, keySize=1024):
+        self.executor = executor
+        self.size = size
+        self.keySize = keySize
+        self.pairs = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.taken = 0
+        self.empty = 0
+
+    #: Generate the missing pairs
+    #!? A broken or shut down executor is logged, the pairs are then generated by generateKeys when they are needed
+    def fill(self):
+        futures = []
+
+        with self.lock:
+            while self.pairs.qsize() + self.pending < self.size:
+                try:
+                    futures.append(self.executor.submit(newKeyPair, self.keySize))
+                except (BrokenExecutor, RuntimeError) as e:
+                    logger.error(f'Key pair generation could not be queued: {e!r}')
+                    break
+
+                self.pending += 1
+
+        #!? A future which is already done runs the callback here, and the callback takes the lock
+        for future in futures:
+            future.add_done_callback(self.generated)
+
+    def generated(self, future):
+        with self.lock:
+            self.pending -= 1
+
+        #!? A failed pair is not generated again until the next pair is taken
+        try:
+            self.pairs.put(future.result())
+        except Exception as e:
+            logger.error(f'Key pair generation failed: {e}')
+
+    #: Return a pair from the pool, None if the pool is empty
+    def get(self):
+        try:
+            pair = self.pairs.get_nowait()
+            self.taken += 1
+        except queue.Empty:
+            pair = None
+            self.empty += 1
+
+        self.fill()
+
+        return pair
+
+    def stats(self):
+        return {'depth': self.pairs.qsize(), 'size': self.size, 'pending': self.pending, 'taken': self.taken, 'empty': self.empty}
+
+#! Cipher texts of the envelope format start with its version, the chunked RSA format has no prefix
+envelopePrefix = 'v2:'
+
+#: Encryption with a random AES-256-GCM key, which is encrypted with RSA using publicKey
+#!? Stored as envelopePrefix + base64(encrypted key + nonce + tag + cipher text), so decryption needs one RSA operation for any length
 def encrypt(text, publicKey):
+    publicKey = RSA.importKey(publicKey)
+    dataKey = get_random_bytes(32)
+
+    aes = AES.new(dataKey, AES.MODE_GCM, nonce=get_random_bytes(12))
+    cipherText, tag = aes.encrypt_and_digest(text.encode())
+    encryptedKey = PKCS1_OAEP.new(key=publicKey).encrypt(dataKey)
+
+    return envelopePrefix + b64encode(encryptedKey + aes.nonce + tag + cipherText).decode()
+
+#: Encryption with RSA using publicKey in the old chunked format
+def encryptChunked(text, publicKey):
     publicKey = RSA.importKey(publicKey)
     cipher = PKCS1_OAEP.new(key=publicKey)
 
@@ -33,13 +123,66 @@ def encrypt(text, publicKey):
 
     return cipherText
 
+#: Encrypt the texts with the processes of the executor, returns the cipher texts in the order of the texts
+#!? The texts are encrypted here if the executor is broken
+def encryptMany(texts, publicKey, executor=None):
+    if executor is not None and len(texts) > 1:
+        try:
+            return list(executor.map(encrypt, texts, repeat(publicKey)))
+        except (BrokenExecutor, RuntimeError) as e:
+            logger.error(f'Encrypting in this process, the executor failed: {e!r}')
+
+    return [encrypt(text, publicKey) for text in texts]
+
+#: Decrypt the cipher texts with the processes of the executor, returns the texts in the order of the cipher texts
+#!? The cipher texts are sent in batches, so every process decrypts the privateKey once per batch
+#!? The cipher texts are decrypted here if the executor is broken
+def decryptMany(cipherTexts, privateKey, passphrase, executor=None, batchSize=8):
+    if executor is not None and len(cipherTexts) > 1:
+        batches = [cipherTexts[i:i+batchSize] for i in range(0, len(cipherTexts), batchSize)]
+
+        try:
+            return [text for batch in executor.map(decryptBatch, batches, repeat(privateKey), repeat(passphrase)) for text in batch]
+        except (BrokenExecutor, RuntimeError) as e:
+            logger.error(f'Decrypting in this process, the executor failed: {e!r}')
+
+    return decryptBatch(cipherTexts, privateKey, passphrase)
+
+def decryptBatch(cipherTexts, privateKey, passphrase):
+    privateKey = loadPrivateKey(privateKey, passphrase)
+
+    return [decryptWithKey(cipherText, privateKey) for cipherText in cipherTexts]
+
+#: Return True if the cipherText is in the old chunked format
+def isChunked(cipherText):
+    return not cipherText.startswith(envelopePrefix)
+
 #: Decryption with RSA using privateKey
 def decrypt(cipherText, privateKey, passphrase):
-    #! Decrypting privateKey
+    return decryptWithKey(cipherText, loadPrivateKey(privateKey, passphrase))
+
+#: Decrypt the privateKey with the passphrase and import it
+def loadPrivateKey(privateKey, passphrase):
     aes = AESCipher(passphrase)
     decryptedPrivateKey = aes.decrypt(privateKey)
 
-    privateKey = RSA.importKey(decryptedPrivateKey)
+    return RSA.importKey(decryptedPrivateKey)
+
+#: Decryption with RSA using the privateKey returned by loadPrivateKey, for both of the formats
+def decryptWithKey(cipherText, privateKey):
+    if isChunked(cipherText):
+        return decryptChunked(cipherText, privateKey)
+
+    data = b64decode(cipherText[len(envelopePrefix):])
+    keySize = privateKey.size_in_bytes()
+
+    encryptedKey, nonce, tag, cipherText = data[:keySize], data[keySize:keySize+12], data[keySize+12:keySize+28], data[keySize+28:]
+    dataKey = PKCS1_OAEP.new(key=privateKey).decrypt(encryptedKey)
+
+    return AES.new(dataKey, AES.MODE_GCM, nonce=nonce).decrypt_and_verify(cipherText, tag).decode()
+
+#: Decryption of the old chunked format
+def decryptChunked(cipherText, privateKey):
     decrypt = PKCS1_OAEP.new(key=privateKey)
 
     #! Split the cipherText with comma to deprypt them individually and concatenate them together
@@ -49,7 +192,37 @@ def decrypt(cipherText, privateKey, passphrase):
         text+= decrypt.decrypt(cT).decode()
 
     return text
- 
+
+#: Imported private keys of the unlocked users, so the key is not derived again for every decryption
+#!? A key is removed after idleTtl seconds without use. Only the reference of the cache is dropped,
+#!? because a handler or the token refresher may still be decrypting with the key returned by get() or peek().
+class keyCache():
+    def __init__(self, idleTtl=900, maxSize=10000):
+        self.keys = cache.ttlCache(maxSize, idleTtl)
+
+    #: Return the key of the user, None if the user has no key in the cache
+    def get(self, userId):
+        privateKey = self.keys.get(userId, None)
+
+        #!? Setting the key again restarts its idle time
+        if privateKey is not None:
+            self.keys.set(userId, privateKey)
+
+        return privateKey
+
+    #: Return the key of the user without restarting its idle time, for the background tasks
+    def peek(self, userId):
+        return self.keys.get(userId, None)
+
+    def set(self, userId, privateKey):
+        self.keys.set(userId, privateKey)
+
+    def delete(self, userId):
+        self.keys.delete(userId)
+
+    def stats(self):
+        return self.keys.stats()
+
 #: Encryption and Decryption with AES-128-CBC
 class AESCipher():
     def __init__(self, key):
@@ -0,0 +1,116 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger('catch_all')
+
+#: Refreshes the tokens of the accounts shortly before they expire, in a background thread
+#!? Every interval seconds, up to batchSize of the tokens expiring in refreshBefore seconds are queued, at most rate per second.
+#!? findAccounts(after, before, limit, afterId) returns up to limit expiring accounts, refresh(account) returns False if the account was skipped.
+#!? A run reads at most scanSize accounts and the next run continues after them, so the skipped accounts don't hide the others.
+#!? refresh() queues the call wrapped by track(), so the refreshed and failed counters are of the calls which finished.
+class tokenRefresher():
+    def __init__(self, findAccounts, refresh, interval=60, refreshBefore=300, batchSize=20, rate=5, scanSize=200):
+        self.findAccounts = findAccounts
+        self.refresh = refresh
+        self.interval = interval
+        self.refreshBefore = refreshBefore
+        self.batchSize = batchSize
+        self.rate = rate
+        self.scanSize = scanSize
+        self.cursor = (0, 0)
+        self.lock = threading.Lock()
+        self.running = set()
+        self.queued = 0
+        self.refreshed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.lastRun = None
+
+    def start(self):
+        threading.Thread(target=self.run, name='tokenRefresher', daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                self.runOnce()
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+            time.sleep(self.interval)
+
+    #: Queue the refresh of a batch of the expiring tokens
+    def runOnce(self):
+        now = time.time()
+        self.lastRun = now
+        queued = 0
+
+        after, afterId = self.cursor if self.cursor[0] > now else (now, 0)
+        accounts = self.findAccounts(after, now + self.refreshBefore, self.scanSize, afterId)
+        cursor = (0, 0)
+
+        for account in accounts:
+            if queued >= self.batchSize:
+                break
+
+            cursor = (account[3], account[0])
+
+            #!? The refresh queued by the last run has not finished yet
+            with self.lock:
+                if account[0] in self.running:
+                    continue
+
+            try:
+                queuedRefresh = self.refresh(account)
+
+            except Exception as e:
+                queuedRefresh = None
+                logger.error(e, exc_info=True)
+
+            #!? A refresh which was not queued will not run, so the account is not running
+            if not queuedRefresh:
+                with self.lock:
+                    self.running.discard(account[0])
+
+                    if queuedRefresh is None:
+                        self.failed += 1
+                    else:
+                        self.skipped += 1
+                continue
+
+            queued += 1
+            self.queued += 1
+
+            #! Rate limit of the refresh calls to Ncell
+            time.sleep(1 / self.rate)
+
+        #!? The next run continues after the last account of this run, or from the tokens expiring now if this run reached the end of the window
+        self.cursor = cursor if queued >= self.batchSize or len(accounts) == self.scanSize else (0, 0)
+
+    #: Return the refresh call of the account which counts its outcome, succeeded(result) tells if the token was refreshed
+    def track(self, accountId, function, succeeded):
+        with self.lock:
+            self.running.add(accountId)
+
+        def call(*args):
+            refreshed = False
+            try:
+                result = function(*args)
+                refreshed = succeeded(result)
+
+                return result
+
+            finally:
+                with self.lock:
+                    self.running.discard(accountId)
+
+                    if refreshed:
+                        self.refreshed += 1
+                    else:
+                        self.failed += 1
+
+        return call
+
+    def stats(self):
+        with self.lock:
+            return {'queued': self.queued, 'refreshed': self.refreshed, 'skipped': self.skipped, 'failed': self.failed, 'running': len(self.running), 'lastRun': self.lastRun}
@@ -0,0 +1,138 @@
+import time
+import random
+import threading
+from functools import partial
+
+import requests
+
+#! Methods of the Ncell clients which only read, so they are safe to retry
+readMethods = ['viewBalance', 'viewProfile', 'subscribedProducts', 'dataPlans', 'voiceAndSmsPlans', 'vasPlans']
+
+#! Timeout of the requests of the current thread, set by the guarded client for the method being called
+local = threading.local()
+
+#: Return the timeout for the request of the current thread
+def requestTimeout(default):
+    return getattr(local, 'timeout', None) or default
+
+#: Response returned instead of calling Ncell when it is not available
+#!? Has the attributes of the Ncell responses which the handlers read, so they take their unknown error path
+class unavailableResponse():
+    def __init__(self, description, statusCode=503):
+        self.responseDescCode = 'unavailable'
+        self.responseDesc = description
+        self.statusCode = statusCode
+        self.responseHeader = {'responseCode': str(statusCode), 'responseDescCode': 'unavailable', 'responseDesc': description, 'responseDescDisplay': description}
+        self.content = {}
+
+#: Stops the calls to Ncell after failureThreshold failures in a row, and lets one call try again after resetTimeout seconds
+class circuitBreaker():
+    def __init__(self, failureThreshold=5, resetTimeout=30):
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.openedAt = 0
+        self.opened = 0
+        self.rejected = 0
+
+    #: Return True if a call is allowed
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+
+            #!? One call tries again after resetTimeout, the others are rejected until it succeeds
+            if self.state == 'open' and time.monotonic() - self.openedAt >= self.resetTimeout:
+                self.state = 'halfOpen'
+                return True
+
+            self.rejected += 1
+            return False
+
+    def success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+
+            if self.state == 'halfOpen' or (self.state == 'closed' and self.failures >= self.failureThreshold):
+                self.state = 'open'
+                self.openedAt = time.monotonic()
+                self.opened += 1
+
+    def stats(self):
+        with self.lock:
+            return {'state': self.state, 'failures': self.failures, 'opened': self.opened, 'rejected': self.rejected}
+
+#: Timeouts, retries and the circuit breaker of the calls to Ncell
+#!? timeouts has the timeout of every method in seconds, and 'default' for the others
+class guard():
+    def __init__(self, timeouts=None, retries=2, backoff=0.5, failureThreshold=5, resetTimeout=30):
+        self.timeouts = {'default': 10, **(timeouts or {})}
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = circuitBreaker(failureThreshold, resetTimeout)
+
+    #: Return the client with its methods called through the guard
+    def wrap(self, client):
+        return guardedClient(self, client)
+
+    #: Call the method of the client, returns an unavailableResponse if Ncell didn't answer
+    def call(self, name, method, *args, **kwargs):
+        attempts = 1 + (self.retries if name in readMethods else 0)
+        response = None
+
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                break
+
+            #!? Retry after a random wait of up to backoff, 2*backoff, ... seconds, so the retries of the users are spread
+            if attempt:
+                time.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+
+            local.timeout = self.timeouts.get(name, self.timeouts['default'])
+            try:
+                response = method(*args, **kwargs)
+                failed = response.statusCode >= 500
+
+            #!? A timeout, a failed connection or a response which is not JSON
+            except (requests.RequestException, ValueError):
+                failed = True
+
+            #!? Other errors are raised, but still count so a half open breaker is not left waiting
+            except Exception:
+                self.breaker.failure()
+                raise
+
+            finally:
+                local.timeout = None
+
+            if not failed:
+                self.breaker.success()
+                return response
+
+            self.breaker.failure()
+
+        return response or unavailableResponse('Ncell is not responding at the moment, please try again later.')
+
+    def stats(self):
+        return self.breaker.stats()
+
+#: Ncell client whose methods are called through the guard, other attributes are of the client
+class guardedClient():
+    def __init__(self, guard, client):
+        self.guard = guard
+        self.client = client
+
+    def __getattr__(self, name):
+        value = getattr(self.client, name)
+
+        if callable(value) and not name.startswith('_'):
+            return partial(self.guard.call, name, value)
+
+        return value
@@ -0,0 +1,130 @@
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('catch_all')
+
+#: Short lived conversation data of the users kept in memory
+#!? Every key has its own expiry, and the least recently used users are evicted after maxUsers
+class memoryStore():
+    def __init__(self, ttl=3600, maxUsers=10000, maxValueSize=1048576):
+        self.ttl = ttl
+        self.maxUsers = maxUsers
+        self.maxValueSize = maxValueSize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    #: Return the value of the user's key, None if it is not set or expired
+    def get(self, userId, key):
+        with self.lock:
+            keys = self.data.get(userId)
+
+            if keys and key in keys:
+                value, expiresAt = keys[key]
+
+                if expiresAt > time.time():
+                    self.data.move_to_end(userId)
+                    return value
+
+                del keys[key]
+
+        return None
+
+    #: Set the user's key, ttl overrides the default time to live. None deletes the key.
+    #!? A value larger than maxValueSize is not stored and the key is deleted, so the handlers find it missing as if it expired
+    def set(self, userId, key, value, ttl=None):
+        if value is None:
+            return self.delete(userId, key)
+
+        if len(value) > self.maxValueSize:
+            logger.error(f'Session value {key} of {len(value)} bytes is larger than {self.maxValueSize} bytes, not stored')
+            return self.delete(userId, key)
+
+        expiresAt = time.time() + (ttl or self.ttl)
+
+        with self.lock:
+            self.data.setdefault(userId, {})[key] = (value, expiresAt)
+            self.data.move_to_end(userId)
+
+            while len(self.data) > self.maxUsers:
+                self.data.popitem(last=False)
+
+        return expiresAt
+
+    #: Delete the user's key, or all the keys of the user if key is None
+    def delete(self, userId, key=None):
+        with self.lock:
+            if key is None:
+                self.data.pop(userId, None)
+            elif userId in self.data:
+                self.data[userId].pop(key, None)
+
+    #: Return the number of users and keys in the store
+    def stats(self):
+        with self.lock:
+            return {'users': len(self.data), 'keys': sum(len(i) for i in self.data.values()), 'maxUsers': self.maxUsers}
+
+#: Memory store which also writes the sessions to a separate SQLite database, so they survive restarts
+#!? A separate database keeps the session writes off the write lock of the main database
+class sqliteStore(memoryStore):
+    def __init__(self, database='sessions.sqlite', **options):
+        memoryStore.__init__(self, **options)
+        self.database = database
+        self.local = threading.local()
+
+        self.con.execute('''CREATE TABLE IF NOT EXISTS sessions
+            (ownerId    INTEGER NOT NULL,
+            key         TEXT    NOT NULL,
+            value       TEXT    NOT NULL,
+            expiresAt   REAL    NOT NULL,
+            PRIMARY KEY (ownerId, key)
+            );''')
+        self.con.execute('DELETE FROM sessions WHERE expiresAt<?', (time.time(),))
+
+    #: Return the connection of the current thread
+    @property
+    def con(self):
+        con = getattr(self.local, 'con', None)
+
+        if con is None:
+            con = sqlite3.connect(self.database, timeout=10, isolation_level=None)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            self.local.con = con
+
+        return con
+
+    def get(self, userId, key):
+        value = memoryStore.get(self, userId, key)
+
+        #!? Load the key from the database after a restart
+        if value is None:
+            row = self.con.execute('SELECT value, expiresAt FROM sessions WHERE ownerId=? AND key=? AND expiresAt>?', (userId, key, time.time())).fetchone()
+
+            if row:
+                value = row[0]
+                memoryStore.set(self, userId, key, value, ttl=row[1]-time.time())
+
+        return value
+
+    def set(self, userId, key, value, ttl=None):
+        expiresAt = memoryStore.set(self, userId, key, value, ttl)
+
+        #!? The deleted and the oversized values are not written
+        if expiresAt is not None:
+            self.con.execute('''INSERT INTO sessions (ownerId, key, value, expiresAt) VALUES (?, ?, ?, ?)
+                ON CONFLICT (ownerId, key) DO UPDATE SET value=excluded.value, expiresAt=excluded.expiresAt''', (userId, key, value, expiresAt))
+
+    def delete(self, userId, key=None):
+        memoryStore.delete(self, userId, key)
+
+        if key is None:
+            self.con.execute('DELETE FROM sessions WHERE ownerId=?', (userId,))
+        else:
+            self.con.execute('DELETE FROM sessions WHERE ownerId=? AND key=?', (userId, key))
+
+#: Return the session store of the backend from the config
+def new(backend='memory', **options):
+    return {'memory': memoryStore, 'sqlite': sqliteStore}[backend](**options)
@@ -2,10 +2,12 @@ import telebot
 import ncellapp
 from os import path
 from aiohttp import web
-import ast, inspect, logging
+import ast, sys, logging
 import json, base64, time, ssl
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
 
-import mycrypto, models
+import mycrypto, models, migrations, sessions, codec, cache, dispatcher, clients, catalog, resilience, refresher
 
 #!? Finding the absolute path of the config file
 scriptPath = path.abspath(__file__)
@@ -23,10 +25,52 @@ logging.basicConfig(filename=config['telegram']['errorLog'],
 logger = logging.getLogger('catch_all')
 loggerConsole = logging.Logger('catch_all')
 
-dbSql = models.dbQuery(config['database'])
+#! Upgrade the database to the latest schema before using it
+migrations.migrate(config['database'])
+
+dbSql = models.dbQuery(config['database'], **config.get('databaseCache', {}), sessionStore=sessions.new(**config.get('sessionStore', {})))
 language = json.load(open(config['language']))
 
-bot = telebot.TeleBot(config['telegram']['botToken'], parse_mode='HTML')
+#! Private keys of the unlocked users
+unlockedKeys = mycrypto.keyCache(**config.get('unlockedKeys', {}))
+
+#! Timeouts, retries of the reads and the circuit breaker of the calls to Ncell
+ncellGuard = resilience.guard(**config.get('ncellResilience', {}))
+
+#! Warm Ncell clients of the accounts, sending their requests with a shared keep alive session
+clientConfig = config.get('ncellClients', {})
+clients.useSession(clients.newSession(clientConfig.get('poolSize', 16)), ncellGuard.timeouts['default'])
+ncellClients = clients.clientRegistry([__name__, 'autoRefreshToken'], ncellGuard, maxSize=clientConfig.get('maxSize', 5000), ttl=clientConfig.get('ttl', 3600))
+
+#! Concurrent identical Ncell reads share one call
+ncellReads = cache.singleFlight()
+
+#! Balance of the accounts, shown again without calling Ncell for balanceCache.ttl seconds
+balanceConfig = config.get('balanceCache', {})
+balances = cache.ttlCache(balanceConfig.get('maxSize', 10000), balanceConfig.get('ttl', 15))
+
+#! Plan catalog shared by all the users
+#!? The refreshes run on the dispatcher under the user whose client fetches the plans
+planCatalog = catalog.catalogCache(lambda *args: updates.submit(*args), **config.get('planCatalog', {}))
+
+#! Refreshes the tokens of the recently used accounts before they expire
+refreshConfig = config.get('tokenRefresh', {})
+tokenRefresher = refresher.tokenRefresher(dbSql.getExpiringAccounts, lambda account: refreshAccountToken(account), **{i: refreshConfig[i] for i in ['interval', 'refreshBefore', 'batchSize', 'rate', 'scanSize'] if i in refreshConfig})
+
+#! Subscription status of the users in the channel
+#!? Subscribed users are cached longer, so the users who just joined are checked again soon
+subscriptionConfig = config.get('subscriptionCache', {})
+subscriptions = cache.ttlCache(subscriptionConfig.get('maxSize', 10000))
+
+#! Updates the bot receives, chat_member updates of the channel keep the subscription cache fresh
+allowedUpdates = ['message', 'callback_query', 'chat_member']
+
+#!? The updates are run by the dispatcher, so the bot doesn't need its own worker threads
+bot = telebot.TeleBot(config['telegram']['botToken'], parse_mode='HTML', threaded=False)
+
+#! Runs the updates of a user in order and the updates of different users in parallel, up to dispatcher.workers at once
+updates = dispatcher.dispatcher(**config.get('dispatcher', {}))
+processUpdates = bot.process_new_updates
 
 #! Configuration for webhook
 webhookBaseUrl = f"https://{config['telegram']['webhookOptions']['webhookHost']}:{config['telegram']['webhookOptions']['webhookPort']}"
@@ -34,12 +78,42 @@ webhookUrlPath = f"/{config['telegram']['botToken']}/"
 
 app = web.Application()
 
+#: Return the Telegram id of the user who sent the update, the update id if it has no user
+def updateUser(update):
+    for updateType in allowedUpdates:
+        content = getattr(update, updateType, None)
+
+        if content is not None and getattr(content, 'from_user', None):
+            return content.from_user.id
+
+    return update.update_id
+
+#: Queue the update on the dispatcher, returns False if the queue is full
+def dispatchUpdate(update):
+    return updates.submit(updateUser(update), processUpdates, [update])
+
+#: Queue the updates received by polling
+#!? Polling waits while the queue is full, and the offset of the next getUpdates is set here because the updates run later
+def dispatchUpdates(newUpdates):
+    for update in newUpdates:
+        bot.last_update_id = max(bot.last_update_id, update.update_id)
+
+        while not dispatchUpdate(update):
+            time.sleep(0.1)
+
+bot.process_new_updates = dispatchUpdates
+
 #: Process webhook calls
+#!? The update is handled by the dispatcher, so the webhook is answered without waiting for the handler
 async def handle(request):
     if request.match_info.get('token') == bot.token:
         request_body_dict = await request.json()
         update = telebot.types.Update.de_json(request_body_dict)
-        bot.process_new_updates([update])
+
+        #!? Telegram sends the update again later if the queue is full
+        if not dispatchUpdate(update):
+            return web.Response(status=503)
+
         return web.Response()
     else:
         return web.Response(status=403)
@@ -47,20 +121,21 @@ async def handle(request):
 app.router.add_post('/{token}/', handle)
 
 #: Check if the user is subscribed or not, returns True if subscribed
-def isSubscribed(message, sendMessage=True):
-    callerFunction = inspect.stack()[1][3]
+#!? useCache is False to check again when the user says they have joined
+def isSubscribed(message, sendMessage=True, useCache=True):
+    #!? Name of the calling function without walking the whole stack
+    callerFunction = sys._getframe(1).f_code.co_name
     telegramId = message.from_user.id
-    subscribed = True
-    try:
-        status = bot.get_chat_member(config['telegram']['channelId'], telegramId)
-        
-        if status.status == 'left':
-            subscribed = False
-        else:
-            return True
+    subscribed = subscriptions.get(telegramId, None) if useCache else None
 
-    except Exception:
-        subscribed = False
+    if subscribed is None:
+        try:
+            status = bot.get_chat_member(config['telegram']['channelId'], telegramId)
+            subscribed = setSubscribed(telegramId, status.status)
+
+        #!? Failed checks are not cached
+        except Exception:
+            subscribed = False
 
     if not subscribed:
         #!? Send the links if sendMessage is True
@@ -73,6 +148,21 @@ def isSubscribed(message, sendMessage=True):
 
         return False
 
+    return True
+
+#: Cache the subscription status of the user from the status of the chat member, returns True if subscribed
+def setSubscribed(telegramId, status):
+    subscribed = status != 'left'
+    subscriptions.set(telegramId, subscribed, ttl=subscriptionConfig.get('positiveTtl', 600) if subscribed else subscriptionConfig.get('negativeTtl', 30))
+
+    return subscribed
+
+#! Update the subscription cache when a user joins or leaves the channel
+#!? Telegram sends these updates only if the bot is an admin of the channel
+@bot.chat_member_handler(func=lambda update: str(update.chat.id) == str(config['telegram']['channelId']))
+def channelMember(update):
+    setSubscribed(update.new_chat_member.user.id, update.new_chat_member.status)
+
 #: Reply keyboard for cancelling a process
 def cancelReplyKeyboard():
     cancelKeyboard = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
@@ -107,20 +197,18 @@ def mainReplyKeyboard(message):
     button14 = telebot.types.KeyboardButton(text='🔒 Lock')
     button15 = telebot.types.KeyboardButton(text='🔓 Unlock')
 
-    userId = dbSql.getUserId(message.from_user.id)
-    account = dbSql.getAccounts(userId)
+    context = dbSql.getUserContext(message.from_user.id)
 
     #! Reply keyboard for the users with accounts
-    if account:
-        if len(account) > 1:
+    if context.accountCount:
+        if context.accountCount > 1:
             #!? More than one accounts
             keyboard.row(button9, button4, button1)
             keyboard.row(button5, button6, button7)
             
             #!? Lock and unlock buttons for encrypted users
-            if dbSql.getSetting(userId, 'isEncrypted'):
-                isUnlocked = dbSql.getSetting(userId, 'isUnlocked')
-                keyboard.row(button14 if isUnlocked else button15,button3, button11)
+            if context.isEncrypted:
+                keyboard.row(button14 if context.isUnlocked else button15,button3, button11)
             else:
                 keyboard.row(button3, button11, button12)
         else:
@@ -128,18 +216,16 @@ def mainReplyKeyboard(message):
             keyboard.row(button4, button5, button1)
             keyboard.row(button6, button7, button8)
             
-            if dbSql.getSetting(userId, 'isEncrypted'):
-                isUnlocked = dbSql.getSetting(userId, 'isUnlocked')
-                keyboard.row(button14 if isUnlocked else button15,button3, button11)
+            if context.isEncrypted:
+                keyboard.row(button14 if context.isUnlocked else button15,button3, button11)
             else:
                 keyboard.row(button3, button11, button12)
 
     #! Reply keyboard for the users without any account
     else:
         keyboard.row(button2)
-        if dbSql.getSetting(userId, 'isEncrypted'):
-            isUnlocked = dbSql.getSetting(userId, 'isUnlocked')
-            keyboard.row(button14 if isUnlocked else button15,button3)
+        if context.isEncrypted:
+            keyboard.row(button14 if context.isUnlocked else button15,button3)
         else:
             keyboard.row(button3)
         keyboard.row(button11, button12)
@@ -153,18 +239,26 @@ def cancelKeyboardHandler(message):
 
 #: Invalid refresh token handler for callbacks
 def invalidRefreshTokenHandler_cb(call, userId, responseCode):
-    accountId = dbSql.getSetting(userId, 'defaultAcId')
-    dbSql.deleteAccount(userId, accountId)
+    with dbSql.transaction() as tx:
+        accountId = tx.getSetting(userId, 'defaultAcId')
+        tx.deleteAccount(userId, accountId)
+        tx.deleteAllTempdata(userId)
+
+    ncellClients.invalidate(userId, accountId)
+
     bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.id)
     bot.send_message(call.message.chat.id, language['newLoginFound']['en'] if responseCode=='LGN2003' else language['sessionExpired']['en'], reply_markup=mainReplyKeyboard(call))
-    dbSql.deleteAllTempdata(userId)
 
 #: Invalid refresh token handler for messages
 def invalidRefreshTokenHandler(message, userId, responseCode):
-    accountId = dbSql.getSetting(userId, 'defaultAcId')
-    dbSql.deleteAccount(userId, accountId)
+    with dbSql.transaction() as tx:
+        accountId = tx.getSetting(userId, 'defaultAcId')
+        tx.deleteAccount(userId, accountId)
+        tx.deleteAllTempdata(userId)
+
+    ncellClients.invalidate(userId, accountId)
+
     bot.send_message(message.from_user.id, language['newLoginFound']['en'] if responseCode=='LGN2003' else language['sessionExpired']['en'], reply_markup=mainReplyKeyboard(message))
-    dbSql.deleteAllTempdata(userId)
 
 #: Unknown error handler for callbacks
 def unknownErrorHandler_cb(call, description, statusCode):
@@ -186,9 +280,42 @@ def lockedAccountHandler(message, called):
     dbSql.deleteAllTempdata(dbSql.getUserId(message.from_user.id))
     
 #: Updating the token in database after refreshing
-def autoRefreshToken(userId, token):
-    token = encryptIf(userId, token)
-    dbSql.updateAccount(userId,dbSql.getSetting(userId, 'defaultAcId'), token)
+#!? The client which refreshed the token has the new token and is kept, other clients of the account are removed
+def autoRefreshToken(userId, accountId, token):
+    ncellClients.invalidate(userId, accountId, token)
+    dbSql.updateAccount(userId, accountId, encryptIf(userId, token), tokenExpiresAt=tokenExpiry(token))
+
+#: Return when the token expires, the exp of its access token or tokenRefresh.lifetime after now
+def tokenExpiry(token):
+    try:
+        accessToken = ast.literal_eval(base64.b64decode(token).decode())['accessToken']
+        payload = accessToken.split('.')[1]
+
+        return float(json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp'])
+
+    #!? The access token is not a JWT with an exp
+    except Exception:
+        return time.time() + refreshConfig.get('lifetime', 3600)
+
+#: Refresh the token of the account before it expires, returns False if the account is skipped
+#!? Only the accounts used recently have a client, and the accounts of the locked users are skipped
+def refreshAccountToken(account):
+    accountId, userId, telegramId, _ = account
+    client = ncellClients.cached(userId, accountId)
+
+    if client is None:
+        return False
+
+    settings = dbSql.getSettings(userId)
+    if settings.get('isencrypted') and not (settings.get('isunlocked') and unlockedKeys.peek(userId)):
+        return False
+
+    #!? The refresh runs on the dispatcher as an update of the user, so it never runs at the same time as the user's updates
+    return updates.submit(telegramId, tokenRefresher.track(accountId, client.refreshToken, tokenRefreshed))
+
+#: Return True if Ncell refreshed the token, the guard answers with an unavailableResponse when Ncell is down
+def tokenRefreshed(response):
+    return response.responseHeader['responseCode'] == '200'
    
 @bot.message_handler(commands=['start'])
 def start(message):
@@ -207,16 +334,61 @@ def start(message):
 def ping(message):
     bot.send_message(message.from_user.id, text=language['ping']['en'])
 
+#! Runtime stats for the admins
+@bot.message_handler(commands=['stats'])
+def stats(message):
+    if message.from_user.id in config['telegram']['adminList']:
+        text = '<b>📊 Stats</b>\n'
+
+        for name, stat in dbSql.cacheStats().items():
+            text += f"\n{name} cache: {stat['size']}/{stat['maxSize']}, hits {stat['hits']}, misses {stat['misses']} ({stat['hitRate']*100:.1f}%)"
+
+        stat = dbSql.sessions.stats()
+        text += f"\nsessions: {stat['users']}/{stat['maxUsers']} users, {stat['keys']} keys"
+
+        stat = unlockedKeys.stats()
+        text += f"\nunlocked keys: {stat['size']}/{stat['maxSize']}, hits {stat['hits']}, misses {stat['misses']}"
+
+        stat = subscriptions.stats()
+        text += f"\nsubscriptions: {stat['size']}/{stat['maxSize']}, hits {stat['hits']}, misses {stat['misses']} ({stat['hitRate']*100:.1f}%)"
+
+        stat = updates.stats()
+        text += f"\ndispatcher: {stat['queued']} queued for {stat['keys']} users, {stat['workers']} workers, {stat['processed']} processed, {stat['failed']} failed, {stat['rejected']} rejected"
+        text += f"\nupdate wait: p50 {stat['waitP50']} ms, p99 {stat['waitP99']} ms, run: p50 {stat['runP50']} ms, p99 {stat['runP99']} ms"
+
+        stat = ncellClients.stats()
+        text += f"\nncell clients: {stat['size']}/{stat['maxSize']}, hits {stat['hits']}, misses {stat['misses']} ({stat['hitRate']*100:.1f}%)"
+
+        stat = tokenRefresher.stats()
+        text += f"\ntoken refresh: {stat['queued']} queued, {stat['running']} running, {stat['refreshed']} refreshed, {stat['skipped']} skipped, {stat['failed']} failed, last run {time.strftime('%H:%M:%S', time.localtime(stat['lastRun'])) if stat['lastRun'] else 'never'}"
+
+        stat = ncellGuard.stats()
+        text += f"\nncell breaker: {stat['state']}, {stat['failures']} failures, opened {stat['opened']} times, rejected {stat['rejected']} calls"
+
+        stat = ncellReads.stats()
+        text += f"\nncell reads: {stat['calls']} calls, {stat['shared']} shared, {stat['running']} running"
+
+        stat = balances.stats()
+        text += f"\nbalances: {stat['size']}/{stat['maxSize']}, hits {stat['hits']}, misses {stat['misses']} ({stat['hitRate']*100:.1f}%)"
+
+        stat = planCatalog.stats()
+        text += f"\nplan catalog: {stat['size']}/{stat['maxSize']}, hits {stat['hits']}, misses {stat['misses']}, refreshes {stat['refreshes']} ({stat['refreshing']} running)"
+
+        stat = keyPairs.stats()
+        text += f"\nkey pool: {stat['depth']}/{stat['size']} ({stat['pending']} generating), taken {stat['taken']}, empty {stat['empty']}"
+
+        bot.send_message(message.from_user.id, text)
+
 #! Encryption
 @bot.message_handler(commands=['encryption'])
 def encryption(message):
-    userId = dbSql.getUserId(message.from_user.id)
+    context = dbSql.getUserContext(message.from_user.id)
     
     markup = telebot.types.InlineKeyboardMarkup()
     markup.one_time_keyboard=True
     markup.row_width = 2
         
-    if dbSql.getSetting(userId, 'isEncrypted'):
+    if context.isEncrypted:
         markup.add(telebot.types.InlineKeyboardButton('Change passphrase', callback_data='cb_changePassphrase'), telebot.types.InlineKeyboardButton('Remove encryption', callback_data='cb_encryptionRemove'), telebot.types.InlineKeyboardButton('❌ Cancel', callback_data='cb_cancel'))
         bot.send_message(message.from_user.id, text=language['encryption']['en'], reply_markup=markup, disable_web_page_preview=True)
         
@@ -241,25 +413,27 @@ def encryptionSetup(message):
         key = message.text + extraPassphrase
 
         PassphraseHash = mycrypto.genHash(message.text)
-        privateKey, publicKey = mycrypto.generateKeys(key)
+        privateKey, publicKey = mycrypto.generateKeys(key, pool=keyPairs)
 
         userId = dbSql.getUserId(message.from_user.id)
-        accounts = dbSql.getAccounts(userId)
+        accounts = dbSql.getAccounts(userId) or []
 
-        #! Encrypt existing accounts
-        if accounts:
-            for account in accounts:
-                accountId = account[0]
-                encryptedToken = mycrypto.encrypt(account[1], publicKey)
+        #!? Encrypt the tokens in the crypto processes before the transaction, so the database is not locked while encrypting
+        encryptedTokens = mycrypto.encryptMany([account[1] for account in accounts], publicKey, executor=cryptoExecutor)
 
-                dbSql.updateAccount(userId, accountId, encryptedToken)
+        with dbSql.transaction() as tx:
+            #! Encrypt existing accounts and mask their MSISDN
+            for account, encryptedToken in zip(accounts, encryptedTokens):
+                tx.updateAccount(userId, account[0], encryptedToken)
+                tx.setDisplayMsisdn(userId, account[0], displayMsisdn(tokenMsisdn(account[1]), isEncrypted=True))
 
-        dbSql.setSetting(userId, 'privateKey', privateKey)
-        dbSql.setSetting(userId, 'publicKey', publicKey)
-        dbSql.setSetting(userId, 'PassphraseHash', PassphraseHash)
-        dbSql.setSetting(userId, 'isEncrypted', True)
-        dbSql.setSetting(userId, 'isUnlocked', None)
+            tx.setSetting(userId, 'privateKey', privateKey)
+            tx.setSetting(userId, 'publicKey', publicKey)
+            tx.setSetting(userId, 'PassphraseHash', PassphraseHash)
+            tx.setSetting(userId, 'isEncrypted', True)
+            tx.setSetting(userId, 'isUnlocked', None)
 
+        unlockedKeys.delete(userId)
         bot.send_message(message.from_user.id, text=language['encryptionSuccess']['en'], reply_markup=mainReplyKeyboard(message))
 
 #: Change encryption passphrase
@@ -269,33 +443,30 @@ def changePassphrase(message):
     
     elif len(message.text) < 8:
         sent = bot.send_message(message.from_user.id, text=language['invalidPasspharse']['en'], reply_markup=cancelReplyKeyboard())
-        bot.register_next_step_handler(sent, changePassphrase2)
+        bot.register_next_step_handler(sent, changePassphrase)
 
     else:
-        userId = dbSql.getUserId(message.from_user.id)
-        oldPassphrase = pinnedText(message)[0]
+        context = dbSql.getUserContext(message.from_user.id)
+        userId = context.userId
+        privateKey = unlockedKey(message, context)
 
-        if mycrypto.genHash(oldPassphrase) == dbSql.getSetting(userId, 'passphraseHash'):
+        if privateKey:
             #! If new passphrase is same as old passphrase
-            if message.text == oldPassphrase:
+            if mycrypto.genHash(message.text) == context.passphraseHash:
                 sent = bot.send_message(message.from_user.id, text=language['samePassphrase']['en'], reply_markup=cancelReplyKeyboard())
-                bot.register_next_step_handler(sent, changePassphrase2)
+                bot.register_next_step_handler(sent, changePassphrase)
             
             else:
-                #! Decrypt the privatekey
-                encryptedPrivateKey = dbSql.getSetting(userId, 'privateKey')
-                aes = mycrypto.AESCipher(oldPassphrase + '0'*(16-len(oldPassphrase)))
-
-                privateKey = aes.decrypt(encryptedPrivateKey)
-
-                #! Encrypt the private key with the new passphrase
+                #! Encrypt the private key of the unlocked session with the new passphrase
                 aes = mycrypto.AESCipher(message.text + '0'*(16-len(message.text)))
-                encryptedPrivateKey = aes.encrypt(privateKey)
+                encryptedPrivateKey = aes.encrypt(privateKey.exportKey().decode())
                 
-                dbSql.setSetting(userId, 'privateKey', encryptedPrivateKey)
-                dbSql.setSetting(userId, 'passphraseHash', mycrypto.genHash(message.text))
-                dbSql.setSetting(userId, 'isUnlocked', None)
+                with dbSql.transaction() as tx:
+                    tx.setSetting(userId, 'privateKey', encryptedPrivateKey)
+                    tx.setSetting(userId, 'passphraseHash', mycrypto.genHash(message.text))
+                    tx.setSetting(userId, 'isUnlocked', None)
 
+                unlockedKeys.delete(userId)
                 bot.send_message(message.from_user.id, text=language['passphraseChangeSuccess']['en'], reply_markup=mainReplyKeyboard(message))
                 bot.unpin_all_chat_messages(message.from_user.id)
         else:
@@ -308,23 +479,24 @@ def encryptionRemove(message):
         cancelKeyboardHandler(message)
     
     elif mycrypto.genHash(message.text) == dbSql.getSetting(userId, 'passphraseHash'):
-        accounts = dbSql.getAccounts(userId)
+        accounts = dbSql.getAccounts(userId) or []
+        privateKey = dbSql.getSetting(userId, 'privateKey')
 
-        if accounts:
-            for account in accounts:
-                accountId = account[0]
-                encryptedToken = account[1]
-                privateKey = dbSql.getSetting(userId, 'privateKey')
+        #!? Decrypt the tokens in the crypto processes before the transaction, so the database is not locked while decrypting
+        tokens = mycrypto.decryptMany([account[1] for account in accounts], privateKey, message.text+'0'*(16-len(message.text)), executor=cryptoExecutor)
 
-                token = mycrypto.decrypt(encryptedToken, privateKey, passphrase=message.text+'0'*(16-len(message.text)))
-                dbSql.updateAccount(userId, accountId, token)
+        with dbSql.transaction() as tx:
+            for account, token in zip(accounts, tokens):
+                tx.updateAccount(userId, account[0], token)
+                tx.setDisplayMsisdn(userId, account[0], tokenMsisdn(token))
 
-        dbSql.setSetting(userId, 'isEncrypted', None)
-        dbSql.setSetting(userId, 'isUnlocked', True)
-        dbSql.setSetting(userId, 'privateKey', None)
-        dbSql.setSetting(userId, 'publicKey', None)
-        dbSql.setSetting(userId, 'passphraseHash', None)
+            tx.setSetting(userId, 'isEncrypted', None)
+            tx.setSetting(userId, 'isUnlocked', True)
+            tx.setSetting(userId, 'privateKey', None)
+            tx.setSetting(userId, 'publicKey', None)
+            tx.setSetting(userId, 'passphraseHash', None)
 
+        unlockedKeys.delete(userId)
         bot.send_message(message.from_user.id, text=language['encryptionRemoved']['en'], reply_markup=mainReplyKeyboard(message))
         bot.unpin_all_chat_messages(message.from_user.id)
     
@@ -344,21 +516,44 @@ def encryptIf(userId, text):
         return text
 
 #: Decrypt if encryption is on
-def decryptIf(message, text):
-    userId = dbSql.getUserId(message.from_user.id)
+#!? Pass the userContext if the handler has already loaded it
+#!? Pass the accountId if the text is the token of the account, to upgrade the token of the old chunked format
+def decryptIf(message, text, context=None, accountId=None):
+    context = context or dbSql.getUserContext(message.from_user.id)
 
-    if dbSql.getSetting(userId, 'isEncrypted'):
+    if context.isEncrypted:
+        privateKey = unlockedKey(message, context)
+
+        if privateKey:
+            decryptedText = mycrypto.decryptWithKey(text, privateKey)
+
+            #! Encrypt the token again in the envelope format
+            #!? Only if the token was not changed since it was read, for example by a token refresh
+            if accountId and mycrypto.isChunked(text):
+                dbSql.replaceToken(context.userId, accountId, text, mycrypto.encrypt(decryptedText, context.publicKey))
+
+            return decryptedText
+    else:
+        return text
+
+#: Return the private key of the unlocked session, None if the user is locked
+#!? The pinned passphrase is only read when the key is not cached, after a restart or after it was idle
+def unlockedKey(message, context):
+    if not context.isUnlocked:
+        return None
+
+    privateKey = unlockedKeys.get(context.userId)
+
+    if not privateKey:
         pinned = pinnedText(message)
         #! If passphrase is pinned
         if pinned:
             passphrase = pinned[0]
-            if mycrypto.genHash(passphrase) == dbSql.getSetting(userId, 'passphraseHash'):
-                privateKey = dbSql.getSetting(userId, 'privateKey')
-                decryptedText = mycrypto.decrypt(text, privateKey, passphrase + '0'*(16-len(passphrase)))
+            if mycrypto.genHash(passphrase) == context.passphraseHash:
+                privateKey = mycrypto.loadPrivateKey(context.privateKey, passphrase + '0'*(16-len(passphrase)))
+                unlockedKeys.set(context.userId, privateKey)
 
-                return decryptedText  
-    else:
-        return text
+    return privateKey
 
 #: Get the pinned message
 def pinnedText(message):
@@ -374,6 +569,9 @@ def unlock(message):
 def unlock2(message):
     userId = dbSql.getUserId(message.from_user.id)
     if mycrypto.genHash(message.text) == dbSql.getSetting(userId, 'passphraseHash'):
+        privateKey = mycrypto.loadPrivateKey(dbSql.getSetting(userId, 'privateKey'), message.text + '0'*(16-len(message.text)))
+        unlockedKeys.set(userId, privateKey)
+
         dbSql.setSetting(userId, 'isUnlocked', True)
         bot.send_message(message.from_user.id, language['unlockedSuccessfully']['en'], reply_markup=mainReplyKeyboard(message))
 
@@ -413,7 +611,7 @@ def getOtp(message, called=False):
                     msisdnValid = False
 
         if msisdnValid:
-            ac = ncellapp.register(msisdn)
+            ac = ncellGuard.wrap(ncellapp.register(msisdn))
             response = ac.sendOtp()
 
             #! OTP sent successfully
@@ -455,7 +653,7 @@ def getToken(message):
     else:
         userId = dbSql.getUserId(message.from_user.id)
         msisdn = dbSql.getTempdata(userId, 'registerMsisdn')
-        ac = ncellapp.register(msisdn)
+        ac = ncellGuard.wrap(ncellapp.register(msisdn))
 
         if message.text == '🔁 Re-send OTP' and msisdn:
             response = ac.sendOtp()
@@ -491,7 +689,7 @@ def getToken(message):
                 #! Successfully registered
                 if response.responseDescCode == 'OTP1000':
                     token = encryptIf(userId, ac.token)
-                    dbSql.setAccount(userId, token, mycrypto.genHash(msisdn))
+                    dbSql.setAccount(userId, token, mycrypto.genHash(msisdn), displayMsisdn(msisdn, dbSql.getSetting(userId, 'isEncrypted')), tokenExpiry(ac.token))
                     
                     #!? Remove the register msisdn from the database
                     dbSql.setTempdata(userId, 'registerMsisdn', None)
@@ -522,6 +720,27 @@ def getToken(message):
                 sent = bot.send_message(message.from_user.id, language['invalidOtp']['en'], reply_markup=cancelReplyKeyboardOtp())
                 bot.register_next_step_handler(sent, getToken)
 
+#: MSISDN stored in the plain token
+def tokenMsisdn(token):
+    return ast.literal_eval(base64.b64decode(token).decode())['msisdn']
+
+#: MSISDN shown for an account, masked if the account is encrypted
+def displayMsisdn(msisdn, isEncrypted):
+    return f'{msisdn[:3]}****{msisdn[-3:]}' if isEncrypted else msisdn
+
+#: Return the MSISDN shown for the account without decrypting the token, None if it can't be known
+#!? Accounts added before the displayMsisdn column are decrypted once and updated
+def accountMsisdn(message, account, context):
+    if account[4]:
+        return account[4]
+
+    token = decryptIf(message, account[1], context, accountId=account[0])
+    if token:
+        msisdn = displayMsisdn(tokenMsisdn(token), context.isEncrypted)
+        dbSql.setDisplayMsisdn(context.userId, account[0], msisdn)
+
+        return msisdn
+
 #: Manage accounts
 @bot.message_handler(commands=['accounts'])
 def accounts(message):
@@ -530,15 +749,14 @@ def accounts(message):
 
 #: Markup for accounts, return None if accounts is None
 def genMarkup_accounts(message, action):
-    userId = dbSql.getUserId(message.from_user.id)
-    accounts = dbSql.getAccounts(userId)
-    defaultAcId = dbSql.getSetting(userId, 'defaultAcId')
+    context = dbSql.getUserContext(message.from_user.id)
+    accounts = dbSql.getAccounts(context.userId) if context.accountCount else None
+    defaultAcId = context.defaultAcId
 
     if accounts:
         buttons = []
         for i, account in enumerate(accounts):
-            token = decryptIf(message, account[1])
-            msisdn =  ast.literal_eval(base64.b64decode(token).decode())['msisdn'] if token else f'Encrypted {i+1}' 
+            msisdn = accountMsisdn(message, account, context) or f'Encrypted {i+1}'
             accountId = account[0]
             
             #!? Emoji for logged in account
@@ -567,12 +785,13 @@ def genMarkup_accounts(message, action):
 #: Instantly login as another account
 @bot.message_handler(commands=['switch'])
 def switch(message):
-    userId = dbSql.getUserId(message.from_user.id)
-    accounts = dbSql.getAccounts(userId)
+    context = dbSql.getUserContext(message.from_user.id)
+    userId = context.userId
+    accounts = dbSql.getAccounts(userId) if context.accountCount else None
 
     if accounts:
         if len(accounts) > 1:
-            defaultAcID = dbSql.getSetting(userId, 'defaultAcId')
+            defaultAcID = context.defaultAcId
 
             #!? Get the index of current default account
             for i,j in enumerate(accounts):
@@ -594,30 +813,45 @@ def switch(message):
 
                 defaultAcIndex = 1
             
-            account = dbSql.getDefaultAc(userId)
-            token = decryptIf(message, account[1])
-            msisdn = ast.literal_eval(base64.b64decode(token).decode())['msisdn'] if token else f'encrypted {defaultAcIndex}'
+            account = accounts[defaultAcIndex-1]
+            msisdn = accountMsisdn(message, account, context) or f'encrypted {defaultAcIndex}'
             bot.send_message(message.chat.id, f"{language['loggedinAs']['en'].format(msisdn)}")
     else:
         register(message)
 
+#: Return the balance response of the account and the time it was fetched
+#!? The balance is reused for balanceCache.ttl seconds unless refresh is True, and concurrent calls of the account share one request
+def viewBalance(acc, accountId, refresh=False):
+    cached = None if refresh else balances.get(accountId, None)
+
+    if cached:
+        return cached
+
+    response, _ = ncellReads.do(('viewBalance', accountId), acc.viewBalance)
+    fetchedAt = time.time()
+
+    if response.responseDescCode == 'BAL1000':
+        balances.set(accountId, (response, fetchedAt))
+
+    return response, fetchedAt
+
 #: Balance check  
 @bot.message_handler(commands=['balance'])
-def balance(message, called=False):
+def balance(message, called=False, refresh=False):
     if called or isSubscribed(message):
-        userId = dbSql.getUserId(message.from_user.id)
-        account = dbSql.getDefaultAc(userId)
+        context = dbSql.getUserContext(message.from_user.id)
+        userId, account = context.userId, context.defaultAc
         
         if account:
-            if dbSql.getSetting(userId, 'isUnlocked'):
-                token = decryptIf(message, account[1])
+            if context.isUnlocked:
+                token = decryptIf(message, account[1], context, accountId=account[0])
                 if token:
-                    acc = ncellapp.ncell(token=token, autoRefresh=True, afterRefresh=[__name__, 'autoRefreshToken'], args=[userId, '__token__']) 
-                    response = acc.viewBalance()
+                    acc = ncellClients.get(userId, account[0], token)
+                    response, fetchedAt = viewBalance(acc, account[0], refresh)
                     
                     #! Success
                     if response.responseDescCode == 'BAL1000':
-                        balanceFormat(message, response.content['queryBalanceResponse'], called)
+                        balanceFormat(message, response.content['queryBalanceResponse'], called, fetchedAt)
                     
                     #! Invalid refresh token
                     elif response.responseDescCode in ['LGN2003', 'LGN2004']:
@@ -642,7 +876,7 @@ def balance(message, called=False):
             register(message)
 
 #: Balance parser
-def balanceFormat(message, response, called):
+def balanceFormat(message, response, called, fetchedAt):
     text = f"<b>💰 Credit Balance</b>\n\nBalance Rs. {response['creditBalanceDetail']['balance']}\nRecharged On: {response['creditBalanceDetail']['lastRechargeDate']}"
 
     #! If SMS balance
@@ -677,36 +911,33 @@ def balanceFormat(message, response, called):
     #! If unpaid loans
     if response['creditBalanceDetail']['loanAmount'] > 0:
         text += f"\n\n<b>💸 Loan</b>\n\nLoan amount Rs. {response['creditBalanceDetail']['loanAmount']}\nLoan taken on: {response['creditBalanceDetail']['lastLoanTakenDate']}"
-        
-        if called:
-            bot.edit_message_text(chat_id=message.message.chat.id, message_id=message.message.id, text=text)
-        else:
-            bot.send_message(message.from_user.id, text)
-    
-    #! If no unpaid loans
+
+    #!? The time of the balance, it is shown from the cache for a while
+    text += f"\n\n<em>Updated at {time.strftime('%H:%M:%S', time.localtime(fetchedAt))}</em>"
+
+    markup = telebot.types.InlineKeyboardMarkup()
+    markup.one_time_keyboard=True
+
+    #! If no unpaid loans and the balance is less than 5, send take loan button
+    if response['creditBalanceDetail']['loanAmount'] <= 0 and response['creditBalanceDetail']['balance'] <= 5:
+        markup.add(telebot.types.InlineKeyboardButton('🙏 Take Loan', callback_data='cb_confirmLoan'))
+
+    markup.add(telebot.types.InlineKeyboardButton('🔄 Refresh', callback_data='cb_refreshBalance'))
+
+    if called:
+        bot.edit_message_text(chat_id=message.message.chat.id, message_id=message.message.id, text=text, reply_markup=markup)
     else:
-        markup = None
-        #! If the balance is less than 5, send take loan button
-        if response['creditBalanceDetail']['balance'] <= 5:
-            markup = telebot.types.InlineKeyboardMarkup()
-            markup.one_time_keyboard=True
-   
-            markup.add(telebot.types.InlineKeyboardButton('🙏 Take Loan', callback_data='cb_confirmLoan'))
-            
-        if called:
-            bot.edit_message_text(chat_id=message.message.chat.id, message_id=message.message.id, text=text, reply_markup=markup)
-        else:
-            bot.send_message(message.from_user.id, text, reply_markup=markup)
+        bot.send_message(message.from_user.id, text, reply_markup=markup)
 
 #: Loan
 @bot.message_handler(commands=['loan'])
 def loan(message, called=False):
     if called or isSubscribed(message):
-        userId = dbSql.getUserId(message.from_user.id)
-        account = dbSql.getDefaultAc(userId)
+        context = dbSql.getUserContext(message.from_user.id)
+        account = context.defaultAc
 
         if account:
-            if dbSql.getSetting(userId, 'isUnlocked'):
+            if context.isUnlocked:
                 markup = telebot.types.InlineKeyboardMarkup()
                 markup.one_time_keyboard=True
             
@@ -728,15 +959,15 @@ def loan(message, called=False):
 @bot.message_handler(commands=['profile'])
 def profile(message):
     if isSubscribed(message):
-        userId = dbSql.getUserId(message.from_user.id)
-        account = dbSql.getDefaultAc(userId)
+        context = dbSql.getUserContext(message.from_user.id)
+        userId, account = context.userId, context.defaultAc
 
         if account:
-            if dbSql.getSetting(userId, 'isUnlocked'):
-                token = decryptIf(message, account[1])
+            if context.isUnlocked:
+                token = decryptIf(message, account[1], context, accountId=account[0])
                 
                 if token:
-                    acc = ncellapp.ncell(token, autoRefresh=True, afterRefresh=[__name__, 'autoRefreshToken'], args=[userId, '__token__'])
+                    acc = ncellClients.get(userId, account[0], token)
                     response = acc.viewProfile()
                     
                     #! Success
@@ -789,11 +1020,11 @@ def plans(message):
 
 #: Markup for plans catagory
 def genMarkup_plans(message):
-    userId = dbSql.getUserId(message.from_user.id)
-    account = dbSql.getDefaultAc(userId)
+    context = dbSql.getUserContext(message.from_user.id)
+    account = context.defaultAc
     
     if account:
-        if dbSql.getSetting(userId, 'isUnlocked'):
+        if context.isUnlocked:
             markup = telebot.types.InlineKeyboardMarkup()
             markup.one_time_keyboard=True
             markup.row_width = 2
@@ -810,31 +1041,29 @@ def genMarkup_plans(message):
 
 #: Markup for subscribed products
 def genMarkup_subscribedPlans(message):
-    userId = dbSql.getUserId(message.from_user.id)
-    account = dbSql.getDefaultAc(userId)
+    context = dbSql.getUserContext(message.from_user.id)
+    userId, account = context.userId, context.defaultAc
 
-    if accounts:
-        token = decryptIf(message, account[1])
+    if account:
+        token = decryptIf(message, account[1], context, accountId=account[0])
 
         if token:
             markup = telebot.types.InlineKeyboardMarkup()
             markup.one_time_keyboard=True
             markup.row_width = 2
 
-            ac = ncellapp.ncell(token, autoRefresh=True, afterRefresh=[__name__, 'autoRefreshToken'], args=[userId, '__token__'])
-            response = ac.subscribedProducts()
+            ac = ncellClients.get(userId, account[0], token)
+            response, _ = ncellReads.do(('subscribedProducts', account[0]), ac.subscribedProducts)
             
             #! Success
             if response.responseDescCode == 'BIL2000':
-                #! Set status success for use in callback handler
-                Response = {'status': 'success'}
-                Response['productList'] = response.content['queryAllProductsResponse']['productList']
+                productList = response.content['queryAllProductsResponse']['productList']
 
-                responseData = base64.b64encode(str(Response).encode()).decode()
-                dbSql.setTempdata(userId, 'responseData', responseData)
+                #! Index the products by id for the product info callbacks
+                dbSql.setProducts(userId, 'subscribedProducts', subscribedProductIndex(productList))
 
                 shortButtons =  []
-                for i in Response['productList']:
+                for i in productList:
                     if len(i['name']) <= 15:
                         shortButtons.append(telebot.types.InlineKeyboardButton(i['name'], callback_data=f"cb_subscribedProductInfo:{i['id']}"))
                     else:
@@ -850,7 +1079,7 @@ def genMarkup_subscribedPlans(message):
                 Response = response.responseHeader
                 Response['status'] = response.responseDescCode
 
-                responseData = base64.b64encode(str(Response).encode()).decode()
+                responseData = codec.encode(Response)
                 dbSql.setTempdata(userId, 'responseData', responseData)
 
                 return response.responseDescCode
@@ -861,7 +1090,7 @@ def genMarkup_subscribedPlans(message):
                 Response['status'] = 'error'
                 Response['statusCode'] = response.statusCode
                 
-                responseData = base64.b64encode(str(Response).encode()).decode()
+                responseData = codec.encode(Response)
                 dbSql.setTempdata(userId, 'responseData', responseData)
 
                 return 'unknownError'
@@ -872,6 +1101,38 @@ def genMarkup_subscribedPlans(message):
     else:
         return None
 
+#: Index of the subscribed products by id with the text and actions of the product info
+def subscribedProductIndex(productList):
+    index = {}
+    for productInfo in productList:
+        index[productInfo['id']] = {
+            'text': f"<b>{productInfo['name']}</b>\n\n<em>{productInfo['description']}\n\nSubscribed On: {productInfo['subscriptionDate']}\nExpiry Date: {productInfo['expiryDate']}\n</em>",
+            'subscriptionCode': productInfo['subscriptionCode'],
+            'isDeactivationAllowed': productInfo['isDeactivationAllowed'] == 1,
+        }
+
+    return index
+
+#: Index of the available products by id with the text and actions of the product info
+#!? isBalanceSufficient is None if the packages were fetched with another account, because it depends on the balance of that account
+def productIndex(availablePackages, ownPackages=True):
+    index = {}
+    for productInfo in availablePackages:
+        summary = '</em>\nSummery:\n<em>' if productInfo['accounts'] else ''
+        
+        for i in productInfo['accounts']:
+            summary += f"👉 {i['name']} {i['amount']} {i['amountUom']} valid for {i['validity']}{i['validityUom']}\n"
+        
+        summary += f"\n💰 {productInfo['productOfferingPrice']['priceUom']} {'' if productInfo['productOfferingPrice']['priceUom'] == 'FREE' else productInfo['productOfferingPrice']['price']} {'' if productInfo['productOfferingPrice']['priceUom'] == 'FREE' else productInfo['productOfferingPrice']['priceType']}"
+
+        index[productInfo['id']] = {
+            'text': f"<b>{productInfo['displayInfo']['displayName']}</b>\n\n<em>{productInfo['displayInfo']['description']}\n{summary}</em>",
+            'subscriptionCode': productInfo['techInfo']['subscriptionCode'],
+            'isBalanceSufficient': bool(productInfo['isBalanceSufficient']) if ownPackages else None,
+        }
+
+    return index
+
 #: Markup for dataplans catagory
 def genMarkup_dataPlans():
     markup = telebot.types.InlineKeyboardMarkup()
@@ -886,13 +1147,22 @@ def genMarkup_dataPlans():
         
     return markup
 
+#: Fetch the plans of the catagory
+def fetchPlans(ac, planType, catagoryId):
+    if planType == 'data':
+        return ac.dataPlans(catagoryId)
+    elif planType == 'voice':
+        return ac.voiceAndSmsPlans(catagoryId)
+    elif planType == 'vas':
+        return ac.vasPlans(catagoryId)
+
 #: Markup for products
 def genMarkup_products(message):
-    userId = dbSql.getUserId(message.from_user.id)
-    account = dbSql.getDefaultAc(userId)
+    context = dbSql.getUserContext(message.from_user.id)
+    userId, account = context.userId, context.defaultAc
 
-    if accounts:
-        token = decryptIf(message, account[1])
+    if account:
+        token = decryptIf(message, account[1], context, accountId=account[0])
         
         if token:
             planType = message.data.split(':')[1]
@@ -902,24 +1172,19 @@ def genMarkup_products(message):
             markup.one_time_keyboard=True
             markup.row_width = 2
 
-            ac = ncellapp.ncell(token, autoRefresh=True, afterRefresh=[__name__, 'autoRefreshToken'], args=[userId, '__token__'])
+            ac = ncellClients.get(userId, account[0], token)
 
-            if planType == 'data':
-                response = ac.dataPlans(catagoryId)
-            elif planType == 'voice':
-                response = ac.voiceAndSmsPlans(catagoryId)
-            elif planType == 'vas':
-                response = ac.vasPlans(catagoryId)
+            #! The plans are taken from the shared catalog, the user's client only fetches a missing or old category
+            entry, response = planCatalog.get((planType, catagoryId), lambda: fetchPlans(ac, planType, catagoryId), account[0], message.from_user.id)
 
             #! Success
-            if response.responseDescCode == 'QAP1000':
-                Response = {'status':'success'}
-                Response['availablePackages'] = response.content['availablePackages']
-                
-                responseData = base64.b64encode(str(Response).encode()).decode()
-                dbSql.setTempdata(userId, 'responseData', responseData)
+            if entry:
+                availablePackages = entry.packages
 
-                for item in Response['availablePackages']:
+                #! Index the products by id for the product info callbacks
+                dbSql.setProducts(userId, 'products', productIndex(availablePackages, ownPackages=entry.accountId == account[0]))
+
+                for item in availablePackages:
                     productName = item['displayInfo']['displayName'].replace('Facebook','FB').replace('YouTube','YT').replace('TikTok','TT')
                     price = item['productOfferingPrice']['price'].split('.')[0]
                     productName += f" (Rs. {price})"
@@ -935,7 +1200,7 @@ def genMarkup_products(message):
                 Response = response.responseHeader
                 Response['status'] = response.responseDescCode
 
-                responseData = base64.b64encode(str(Response).encode()).decode()
+                responseData = codec.encode(Response)
                 dbSql.setTempdata(userId, 'responseData', responseData)
 
                 return response.responseDescCode
@@ -946,7 +1211,7 @@ def genMarkup_products(message):
                 Response['status'] = 'error'
                 Response['statusCode'] = response.statusCode
                 
-                responseData = base64.b64encode(str(Response).encode()).decode()
+                responseData = codec.encode(Response)
                 dbSql.setTempdata(userId, 'responseData', responseData)
 
                 return 'unknownError'
@@ -961,10 +1226,10 @@ def genMarkup_products(message):
 @bot.message_handler(commands=['freesms'])
 def freeSms(message):
     if isSubscribed(message):
-        userId = dbSql.getUserId(message.from_user.id)
+        context = dbSql.getUserContext(message.from_user.id)
 
-        if dbSql.getSetting(userId, 'isUnlocked'):
-            if dbSql.getDefaultAc(userId):
+        if context.isUnlocked:
+            if context.defaultAc:
                 sent = bot.send_message(message.from_user.id, language['enterDestinationMsisdn']['en'], reply_markup=cancelReplyKeyboard())
                 bot.register_next_step_handler(sent, sendFreeSms)
             else:
@@ -976,10 +1241,10 @@ def freeSms(message):
 @bot.message_handler(commands=['paidsms'])
 def paidsms(message):
     if isSubscribed(message):
-        userId = dbSql.getUserId(message.from_user.id)
+        context = dbSql.getUserContext(message.from_user.id)
 
-        if dbSql.getSetting(userId, 'isUnlocked'):
-            if dbSql.getDefaultAc(userId):
+        if context.isUnlocked:
+            if context.defaultAc:
                 sent = bot.send_message(message.from_user.id, language['enterDestinationMsisdn']['en'], reply_markup=cancelReplyKeyboard())
                 bot.register_next_step_handler(sent, sendPaidSms)
             else:
@@ -991,10 +1256,10 @@ def paidsms(message):
 @bot.message_handler(commands=['sms'])
 def sms(message):
     if isSubscribed(message):
-        userId = dbSql.getUserId(message.from_user.id)
+        context = dbSql.getUserContext(message.from_user.id)
 
-        if dbSql.getSetting(userId, 'isUnlocked'):
-            if dbSql.getSetting(userId, 'defaultAcId'):
+        if context.isUnlocked:
+            if context.defaultAc:
                 bot.send_message(message.from_user.id, language['sms']['en'], reply_markup=genMarkup_sms())
             else:
                 register(message)
@@ -1040,16 +1305,17 @@ def sendFreeSms2(message):
             cancelKeyboardHandler(message)
         else:
             if len(message.text) <= 1000:
-                userId = dbSql.getUserId(message.from_user.id)
+                context = dbSql.getUserContext(message.from_user.id)
+                userId, account = context.userId, context.defaultAc
                 msisdn = dbSql.getTempdata(userId, 'sendSmsTo')
-                account = dbSql.getDefaultAc(userId)
 
-                token = decryptIf(message, account[1])
+                token = decryptIf(message, account[1], context, accountId=account[0])
 
                 if token:
-                    acc = ncellapp.ncell(token, autoRefresh=True, afterRefresh=[__name__, 'autoRefreshToken'], args=[userId, '__token__'])
+                    acc = ncellClients.get(userId, account[0], token)
 
                     response = acc.sendFreeSms(msisdn, message.text)
+                    balances.delete(account[0])
 
                     if response.responseDescCode == 'SMS1000':
                         #! SMS sent successfully
@@ -1117,17 +1383,18 @@ def sendPaidSms2(message):
         cancelKeyboardHandler(message)
     else:
         if len(message.text) <= 1000:
-            userId = dbSql.getUserId(message.from_user.id)
+            context = dbSql.getUserContext(message.from_user.id)
+            userId, account = context.userId, context.defaultAc
             msisdn = dbSql.getTempdata(userId, 'sendSmsTo')
 
-            account = dbSql.getDefaultAc(userId)
 
-            token = decryptIf(message, account[1])
+            token = decryptIf(message, account[1], context, accountId=account[0])
             
             if token:
-                acc = ncellapp.ncell(token, autoRefresh=True, afterRefresh=[__name__, 'autoRefreshToken'], args=[userId, '__token__'])
+                acc = ncellClients.get(userId, account[0], token)
                 
                 response = acc.sendSms(msisdn, message.text)
+                balances.delete(account[0])
                 if response.responseDescCode == 'SMS1000':
                     #! SMS sent successfully
                     if response.content['sendFreeSMSResponse']['statusCode'] == '0':
@@ -1167,10 +1434,10 @@ def sendPaidSms2(message):
 @bot.message_handler(commands=['selfrecharge'])
 def selfRecharge(message):
     if isSubscribed(message):
-        userId = dbSql.getUserId(message.from_user.id)
+        context = dbSql.getUserContext(message.from_user.id)
 
-        if dbSql.getSetting(userId, 'isUnlocked'):
-            if dbSql.getDefaultAc(userId):
+        if context.isUnlocked:
+            if context.defaultAc:
                 bot.send_message(message.from_user.id, text=language['rechargeMethod']['en'], reply_markup=genMarkup_rechargeMethod('self'))
             else:
                 register(message)
@@ -1181,10 +1448,10 @@ def selfRecharge(message):
 @bot.message_handler(commands=['rechargeothers'])
 def rechargeOthers(message):
     if isSubscribed(message):
-        userId = dbSql.getUserId(message.from_user.id)
+        context = dbSql.getUserContext(message.from_user.id)
 
-        if dbSql.getSetting(userId, 'isUnlocked'):
-            if dbSql.getDefaultAc(userId):
+        if context.isUnlocked:
+            if context.defaultAc:
                 bot.send_message(message.from_user.id, text=language['rechargeMethod']['en'], reply_markup=genMarkup_rechargeMethod('others'))
             else:
                 register(message)
@@ -1195,10 +1462,10 @@ def rechargeOthers(message):
 @bot.message_handler(commands=['recharge'])
 def recharge(message):
     if isSubscribed(message):
-        userId = dbSql.getUserId(message.from_user.id)
+        context = dbSql.getUserContext(message.from_user.id)
 
-        if dbSql.getSetting(userId, 'isUnlocked'):
-            if dbSql.getDefaultAc(userId):
+        if context.isUnlocked:
+            if context.defaultAc:
                 bot.send_message(message.from_user.id, text=language['rechargeTo']['en'], reply_markup=genMarkup_rechargeTo())
             else:
                 register(message)
@@ -1242,13 +1509,14 @@ def selfPinRecharge(message):
                 rpinValid = False
         
         if rpinValid:
-            userId = dbSql.getUserId(message.from_user.id)
-            account = dbSql.getDefaultAc(userId)
+            context = dbSql.getUserContext(message.from_user.id)
+            userId, account = context.userId, context.defaultAc
 
-            token = decryptIf(message, account[1])
+            token = decryptIf(message, account[1], context, accountId=account[0])
             if token:
-                acc = ncellapp.ncell(token, autoRefresh=True, afterRefresh=[__name__, 'autoRefreshToken'], args=[userId, '__token__'])
+                acc = ncellClients.get(userId, account[0], token)
                 response = acc.selfRecharge(message.text)
+                balances.delete(account[0])
 
                 #! Recharge success
                 if 'isRechargeSuccess' in response.content and response.content['isRechargeSuccess'] == True:
@@ -1303,13 +1571,13 @@ def selfOnlineRecharge(message):
             bot.register_next_step_handler(sent, selfOnlineRecharge)
         
         else:
-            userId = dbSql.getUserId(message.from_user.id)
+            context = dbSql.getUserContext(message.from_user.id)
         
-            account = dbSql.getDefaultAc(userId)
+            userId, account = context.userId, context.defaultAc
 
-            token = decryptIf(message, account[1])
+            token = decryptIf(message, account[1], context, accountId=account[0])
             if token:
-                acc = ncellapp.ncell(token, autoRefresh=True, afterRefresh=[__name__, 'autoRefreshToken'], args=[userId, '__token__'])
+                acc = ncellClients.get(userId, account[0], token)
                 
                 response = acc.onlineRecharge(message.text)
 
@@ -1368,15 +1636,16 @@ def rechargeOthersPin2(message):
                 rpinValid = False
         
         if rpinValid:
-            userId = dbSql.getUserId(message.from_user.id)
+            context = dbSql.getUserContext(message.from_user.id)
+            userId, account = context.userId, context.defaultAc
             msisdn = dbSql.getTempdata(userId, 'rechargeTo')
-            account = dbSql.getDefaultAc(userId)
 
-            token = decryptIf(message, account[1])
+            token = decryptIf(message, account[1], context, accountId=account[0])
             if token:
-                acc = ncellapp.ncell(token, autoRefresh=True, afterRefresh=[__name__, 'autoRefreshToken'], args=[userId, '__token__'])
+                acc = ncellClients.get(userId, account[0], token)
                 
                 response = acc.recharge(msisdn, message.text)
+                balances.delete(account[0])
 
                 if 'isRechargeSuccess' in response.content:
                     #! Success
@@ -1461,13 +1730,13 @@ def rechargeOthersOnline2(message):
             bot.register_next_step_handler(sent, rechargeOthersOnline2)
         
         else:
-            userId = dbSql.getUserId(message.from_user.id)
+            context = dbSql.getUserContext(message.from_user.id)
+            userId, account = context.userId, context.defaultAc
             msisdn = dbSql.getTempdata(userId, 'rechargeTo')
             
-            account = dbSql.getDefaultAc(userId)
-            token = decryptIf(message, account[1])
+            token = decryptIf(message, account[1], context, accountId=account[0])
             if token:
-                acc = ncellapp.ncell(token, autoRefresh=True, afterRefresh=[__name__, 'autoRefreshToken'], args=[userId, '__token__'])
+                acc = ncellClients.get(userId, account[0], token)
                 
                 response = acc.onlineRecharge(message.text, msisdn)
 
@@ -1503,7 +1772,7 @@ def callback_query(call):
     
     #! Check whether a user is subscribed or not after clicking button
     elif call.data[:15] == 'cb_isSubscribed':
-        if isSubscribed(call, sendMessage=False):
+        if isSubscribed(call, sendMessage=False, useCache=False):
             callingFunction = call.data.split(':')[1]
             
             bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text=language['thanksForSub']['en'])
@@ -1516,8 +1785,8 @@ def callback_query(call):
 
     #! Encryption setup
     elif call.data == 'cb_encryptionSetup':
-        userId = dbSql.getUserId(call.from_user.id)
-        if not dbSql.getSetting(userId, 'isEncrypted'):
+        context = dbSql.getUserContext(call.from_user.id)
+        if not context.isEncrypted:
             bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.id)
             sent = bot.send_message(chat_id=call.message.chat.id, text=language['encryptionPasspharse']['en'], reply_markup=cancelReplyKeyboard())
             bot.register_next_step_handler(sent, encryptionSetup)
@@ -1526,8 +1795,8 @@ def callback_query(call):
     
     #! Encryption remove
     elif call.data == 'cb_encryptionRemove':
-        userId = dbSql.getUserId(call.from_user.id)
-        if dbSql.getSetting(userId, 'isEncrypted'):
+        context = dbSql.getUserContext(call.from_user.id)
+        if context.isEncrypted:
             bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.id)
             sent = bot.send_message(chat_id=call.message.chat.id, text=language['encryptionRemove']['en'], reply_markup=cancelReplyKeyboard())
             bot.register_next_step_handler(sent, encryptionRemove)
@@ -1536,9 +1805,9 @@ def callback_query(call):
 
     #! Change encryption passphrase
     elif call.data == 'cb_changePassphrase':
-        userId = dbSql.getUserId(call.from_user.id)
-        if dbSql.getSetting(userId, 'isEncrypted'):
-            if dbSql.getSetting(userId, 'isUnlocked'):
+        context = dbSql.getUserContext(call.from_user.id)
+        if context.isEncrypted:
+            if context.isUnlocked:
                 bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.id)
                 sent = bot.send_message(chat_id=call.message.chat.id, text=language['enterNewPassphrase']['en'], reply_markup=cancelReplyKeyboard())
                 bot.register_next_step_handler(sent, changePassphrase)
@@ -1581,6 +1850,7 @@ def callback_query(call):
         accountId = call.data[17:].split(':')[1]
 
         dbSql.deleteAccount(userId, accountId)
+        ncellClients.invalidate(userId, int(accountId))
         bot.answer_callback_query(call.id, f"{language['successfullyLoggedout']['en'].format(msisdn)}")
 
         markup = genMarkup_accounts(message=call, action='remove')
@@ -1628,8 +1898,7 @@ def callback_query(call):
     
     #! Back to recharge menu
     elif call.data == 'cb_backToRecharge':
-        userId = dbSql.getUserId(call.from_user.id)
-        if dbSql.getDefaultAc(userId):
+        if dbSql.getUserContext(call.from_user.id).defaultAc:
             bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text=language['rechargeTo']['en'], reply_markup=genMarkup_rechargeTo())
         else:
             bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text=language['noAccounts']['en'], reply_markup=mainReplyKeyboard(call))
@@ -1640,13 +1909,14 @@ def callback_query(call):
 
     #! Take loan
     elif call.data == 'cb_takeLoan':
-        userId = dbSql.getUserId(call.from_user.id)
-        account = dbSql.getDefaultAc(userId)
-        token = decryptIf(call, account[1])
+        context = dbSql.getUserContext(call.from_user.id)
+        userId, account = context.userId, context.defaultAc
+        token = decryptIf(call, account[1], context, accountId=account[0])
 
         if token:
-            acc = ncellapp.ncell(token, autoRefresh=True, afterRefresh=[__name__, 'autoRefreshToken'], args=[userId, '__token__'])
+            acc = ncellClients.get(userId, account[0], token)
             response = acc.takeLoan()
+            balances.delete(account[0])
             
             #! Loan success
             if response.responseDescCode == 'CL1003':
@@ -1670,6 +1940,10 @@ def callback_query(call):
     elif call.data == 'cb_backToBalance':
         balance(message=call, called=True)
 
+    #! Balance from Ncell instead of the cache
+    elif call.data == 'cb_refreshBalance':
+        balance(message=call, called=True, refresh=True)
+
     #! Send free SMS
     elif call.data == 'cb_freeSms':
         bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.id)
@@ -1694,11 +1968,9 @@ def callback_query(call):
             invalidRefreshTokenHandler_cb(call, userId, responseCode=markup)
                 
         elif markup == 'unknownError':
-            #! Response data is stored in database in b64 encoded form
+            #! Response data is stored in the session store encoded with codec
             encodedResponse = dbSql.getTempdata(userId, 'responseData')
-            decodedResponse = base64.b64decode(encodedResponse.encode()).decode()
-
-            response = ast.literal_eval(decodedResponse)
+            response = codec.decode(encodedResponse)
             unknownErrorHandler_cb(call, response['responseDesc'], response['statusCode'])
         
         #! If no error, send reply markup
@@ -1710,47 +1982,18 @@ def callback_query(call):
         productId = call.data.split(':')[1]
         userId = dbSql.getUserId(call.from_user.id)
 
-        #! Response data is stored in database in b64 encoded form
-        encodedResponse = dbSql.getTempdata(userId, 'responseData')
-        if encodedResponse:
-            decodedResponse = base64.b64decode(encodedResponse.encode()).decode()
-
-            response = ast.literal_eval(decodedResponse)
-
-            if response['status'] == 'success':
+        #! The products are indexed by id in the session store
+        productInfo = dbSql.getProduct(userId, 'subscribedProducts', productId)
 
-                if 'productList' in response.keys():
-                    response = response['productList']
-                    #! Iterate through the response to find the product 
-                    productInfo = None
-                    for i in response:
-                        if i['id'] == productId:
-                            productInfo = i
-                            break
-                    
-                    if productInfo:
-                        markup = telebot.types.InlineKeyboardMarkup()
-                        markup.one_time_keyboard=True
-                        markup.row_width = 2
+        if productInfo:
+            markup = telebot.types.InlineKeyboardMarkup()
+            markup.one_time_keyboard=True
+            markup.row_width = 2
 
-                        markup.add(telebot.types.InlineKeyboardButton(text='Deactivate' if i['isDeactivationAllowed'] == 1 else '⛔ Deactivate', callback_data=f"cb_deactivatePlan:{i['subscriptionCode']}" if i['isDeactivationAllowed'] == 1 else 'cb_deactivationNotAllowed'))
-                        markup.add(telebot.types.InlineKeyboardButton('⬅️ Back' ,callback_data='cb_subscribedPlans'), telebot.types.InlineKeyboardButton('❌ Cancel' ,callback_data='cb_cancel'))
-                    
-                        text = f"<b>{productInfo['name']}</b>\n\n<em>{productInfo['description']}\n\nSubscribed On: {productInfo['subscriptionDate']}\nExpiry Date: {productInfo['expiryDate']}\n</em>"
-                        bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text=text, reply_markup=markup)
+            markup.add(telebot.types.InlineKeyboardButton(text='Deactivate' if productInfo['isDeactivationAllowed'] else '⛔ Deactivate', callback_data=f"cb_deactivatePlan:{productInfo['subscriptionCode']}" if productInfo['isDeactivationAllowed'] else 'cb_deactivationNotAllowed'))
+            markup.add(telebot.types.InlineKeyboardButton('⬅️ Back' ,callback_data='cb_subscribedPlans'), telebot.types.InlineKeyboardButton('❌ Cancel' ,callback_data='cb_cancel'))
 
-                    else:
-                        bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.id)
-                else:
-                    bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.id)
-        
-            #! Invalid refresh token
-            elif response['status'] in ['LGN2003', 'LGN2004']:
-                invalidRefreshTokenHandler_cb(call, userId, response['status'])
-            
-            #! Unknown error
-            else:
-                unknownErrorHandler_cb(call, response['responseDesc'], response['statusCode'])
+            bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text=productInfo['text'], reply_markup=markup)
         
         else:
             bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.id)
@@ -1771,11 +2014,9 @@ def callback_query(call):
             invalidRefreshTokenHandler_cb(call, userId, responseCode=markup)
                 
         elif markup == 'unknownError':
-            #! Response data is stored in database in b64 encoded form
+            #! Response data is stored in the session store encoded with codec
             encodedResponse = dbSql.getTempdata(userId, 'responseData')
-            decodedResponse = base64.b64decode(encodedResponse.encode()).decode()
-
-            response = ast.literal_eval(decodedResponse)
+            response = codec.decode(encodedResponse)
             unknownErrorHandler_cb(call, response['responseDesc'], response['statusCode'])
         
         #! Send reply markup if no errors
@@ -1784,60 +2025,24 @@ def callback_query(call):
     
     #! Product info
     elif call.data[:14] == 'cb_productInfo':
-        productId = call.data.split(':')[1]
+        productId, planType, catagoryId = call.data.split(':')[1:4]
         userId = dbSql.getUserId(call.from_user.id)
 
-        #! Response data is stored in database in b64 encoded form
-        encodedResponse = dbSql.getTempdata(userId, 'responseData')
-        if encodedResponse:
-            decodedResponse = base64.b64decode(encodedResponse.encode()).decode()
-
-            response = ast.literal_eval(decodedResponse)
-
-            if response['status'] == 'success':
-                if 'availablePackages' in response.keys():
-                    response = response['availablePackages']
-                    
-                    #! Iterate through the response to find the product 
-                    productInfo = None
-                    for i in response:
-                        if i['id'] == productId:
-                            productInfo = i
-                            break
-                    
-                    if productInfo:
-                        planType = call.data.split(':')[2]
-                        catagoryId = call.data.split(':')[3]
-                        markup = telebot.types.InlineKeyboardMarkup()
-                        markup.one_time_keyboard=True
-                        markup.row_width = 2
+        #! The products are indexed by id in the session store
+        productInfo = dbSql.getProduct(userId, 'products', productId)
 
-                        markup.add(telebot.types.InlineKeyboardButton(text='Activate' if productInfo['isBalanceSufficient'] else '⛔ Activate', callback_data=f"cb_activatePlan:{productInfo['techInfo']['subscriptionCode']}" if productInfo['isBalanceSufficient'] else 'cb_noEnoughBalanceToSub'))
-                        markup.add(telebot.types.InlineKeyboardButton('⬅️ Back' ,callback_data=f'cb_plans:{planType}:{catagoryId}'), telebot.types.InlineKeyboardButton('❌ Cancel' ,callback_data='cb_cancel'))
+        if productInfo:
+            markup = telebot.types.InlineKeyboardMarkup()
+            markup.one_time_keyboard=True
+            markup.row_width = 2
 
-                        summary = '</em>\nSummery:\n<em>' if productInfo['accounts'] else ''
-                        
-                        for i in productInfo['accounts']:
-                            summary += f"👉 {i['name']} {i['amount']} {i['amountUom']} valid for {i['validity']}{i['validityUom']}\n"
-                        
-                        summary += f"\n💰 {productInfo['productOfferingPrice']['priceUom']} {'' if productInfo['productOfferingPrice']['priceUom'] == 'FREE' else productInfo['productOfferingPrice']['price']} {'' if productInfo['productOfferingPrice']['priceUom'] == 'FREE' else productInfo['productOfferingPrice']['priceType']}"
+            #!? Unknown balance (None) is allowed to activate, Ncell answers if the balance is not sufficient
+            canActivate = productInfo['isBalanceSufficient'] is not False
+            markup.add(telebot.types.InlineKeyboardButton(text='Activate' if canActivate else '⛔ Activate', callback_data=f"cb_activatePlan:{productInfo['subscriptionCode']}" if canActivate else 'cb_noEnoughBalanceToSub'))
+            markup.add(telebot.types.InlineKeyboardButton('⬅️ Back' ,callback_data=f'cb_plans:{planType}:{catagoryId}'), telebot.types.InlineKeyboardButton('❌ Cancel' ,callback_data='cb_cancel'))
 
-                        text = f"<b>{productInfo['displayInfo']['displayName']}</b>\n\n<em>{productInfo['displayInfo']['description']}\n{summary}</em>"
-                        bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text=text, reply_markup=markup)
+            bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.id, text=productInfo['text'], reply_markup=markup)
 
-                    else:
-                        bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.id)
-                else:
-                    bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.id)
-        
-            #! Invalid refresh token
-            elif response['status'] in ['LGN2003', 'LGN2004']:
-                invalidRefreshTokenHandler_cb(call, userId, response['status'])
-            
-            #! Unknown error
-            else:
-                unknownErrorHandler_cb(call, response['responseDesc'], response['statusCode'])
-        
         else:
             bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.id)
 
@@ -1853,14 +2058,15 @@ def callback_query(call):
     elif call.data[:17] == 'cb_deactivatePlan':
         subscriptionCode = call.data[18:]
         
-        userId = dbSql.getUserId(call.from_user.id)
-        account = dbSql.getDefaultAc(userId)
-        token = decryptIf(call, account[1])
+        context = dbSql.getUserContext(call.from_user.id)
+        userId, account = context.userId, context.defaultAc
+        token = decryptIf(call, account[1], context, accountId=account[0])
 
         if token:
-            acc = ncellapp.ncell(token, autoRefresh=True, afterRefresh=[__name__, 'autoRefreshToken'], args=[userId, '__token__'])
+            acc = ncellClients.get(userId, account[0], token)
 
             response = acc.unsubscribeProduct(subscriptionCode)
+            balances.delete(account[0])
 
             #! Success
             if response.responseDescCode == 'BIL1001':
@@ -1884,14 +2090,15 @@ def callback_query(call):
     elif call.data[:15] == 'cb_activatePlan':
         subscriptionCode = call.data[16:]
 
-        userId = dbSql.getUserId(call.from_user.id)
-        account = dbSql.getDefaultAc(userId)
-        token = decryptIf(call, account[1])
+        context = dbSql.getUserContext(call.from_user.id)
+        userId, account = context.userId, context.defaultAc
+        token = decryptIf(call, account[1], context, accountId=account[0])
 
         if token:
-            acc = ncellapp.ncell(token, autoRefresh=True, afterRefresh=[__name__, 'autoRefreshToken'], args=[userId, '__token__'])
+            acc = ncellClients.get(userId, account[0], token)
 
             response = acc.subscribeProduct(subscriptionCode)
+            balances.delete(account[0])
 
             #! Success
             if response.responseDescCode == 'BIL1000':
@@ -1927,6 +2134,7 @@ def replyKeyboard(message):
         userId = dbSql.getUserId(message.from_user.id)
         
         dbSql.setSetting(userId, 'isUnlocked', None)
+        unlockedKeys.delete(userId)
         bot.send_message(message.from_user.id, language['lockedSuccessfully']['en'], reply_markup=mainReplyKeyboard(message))
 
         bot.unpin_all_chat_messages(message.from_user.id)
@@ -1973,13 +2181,25 @@ def replyKeyboard(message):
     else:
         bot.send_message(message.from_user.id, language['helpMenu']['en'])
 
+#! Processes for the CPU heavy encryption, and the pool of the key pairs they generate
+#!? The processes are forked, because spawned processes would run this script again. With fork, the executor
+#!? starts all its workers at the first fill(), so they are created here before the bot starts any thread.
+cryptoConfig = config.get('cryptoPool', {})
+cryptoExecutor = ProcessPoolExecutor(cryptoConfig.get('workers', 2), mp_context=get_context('fork'))
+keyPairs = mycrypto.keyPool(cryptoExecutor, size=cryptoConfig.get('keyPoolSize', 4))
+keyPairs.fill()
+
 #: Polling
+#! Start refreshing the tokens in the background
+if refreshConfig.get('enabled', True):
+    tokenRefresher.start()
+
 if config['telegram']['connectionType'] == 'polling':
     #! Remove previous webhook if exists
     bot.remove_webhook()
     while True:
         try:
-            bot.polling(none_stop=True)
+            bot.polling(none_stop=True, allowed_updates=allowedUpdates)
         except Exception as e:
             #! Logging the error
             logger.error(e, exc_info=True)
@@ -1990,7 +2210,8 @@ if config['telegram']['connectionType'] == 'polling':
 elif config['telegram']['connectionType'] == 'webhook':
     #! Set webhook
     bot.set_webhook(url=webhookBaseUrl + webhookUrlPath,
-                    certificate=open(config['telegram']['webhookOptions']['sslCertificate'], 'r'))
+                    certificate=open(config['telegram']['webhookOptions']['sslCertificate'], 'r'),
+                    allowed_updates=allowedUpdates)
 
     #! Build ssl context
     context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)